@@ -33,12 +33,36 @@ function __ma_ru_time($ru, $index) {
 	return($ru["ru_{$index}.tv_sec"] * 1e6) + $ru["ru_{$index}.tv_usec"];
 }
 
-// Sends the payload to the official `@massaffect` abstract socket hosted locally by the Agent.
+// Sends the payload to the Agent. If it has its datagram socket enabled (`@massaffect.dgram`; see
+// `[agent.socket] dgram_name`) this is a single non-blocking `sendto`, otherwise it falls back to
+// the official `@massaffect` abstract stream socket.
 function massaffect_send(array $payload) {
 	if(!extension_loaded("sockets")) {
 		return;
 	}
 
+	$json = json_encode([
+		"collector" => "wordpress",
+		"ts" => time(),
+		"metrics" => $payload
+	], JSON_UNESCAPED_SLASHES) . "\n";
+
+	$sock = @socket_create(AF_UNIX, SOCK_DGRAM, 0);
+
+	if($sock !== false) {
+		socket_set_nonblock($sock);
+
+		$sent = @socket_sendto($sock, $json, strlen($json), 0, "\0massaffect.dgram");
+		$error = socket_last_error($sock);
+
+		socket_close($sock);
+
+		// Delivered, or the Agent is busy (its queue is full); either way, don't block on it.
+		if($sent !== false || $error === SOCKET_EAGAIN) {
+			return;
+		}
+	}
+
 	$sock = @socket_create(AF_UNIX, SOCK_STREAM, 0);
 
 	if($sock === false) {
@@ -54,12 +78,6 @@ function massaffect_send(array $payload) {
 	$addr = "\0massaffect";
 
 	if(@socket_connect($sock, $addr)) {
-		$json = json_encode([
-			"collector" => "wordpress",
-			"ts" => time(),
-			"metrics" => $payload
-		], JSON_UNESCAPED_SLASHES) . "\n";
-
 		@socket_write($sock, $json, strlen($json));
 	}
 
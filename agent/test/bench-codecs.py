@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Compares the wire codecs (CPU time and bytes per event) on real payloads; for example:
+#
+#   controller/bin/ma-psql.py dumpall -s 2026-03-01 -d "1 hour" > events.ndjson
+#   agent/test/bench-codecs.py events.ndjson
+#
+# Input is either a JSON array of events or newline-delimited JSON (one event per line).
+
+import sys
+import json
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# Always append the "project root" (setup as `ROOT` here) so that the main Python code is found.
+sys.path.insert(0, str(ROOT))
+
+from massaffect import codec
+
+LEVELS = {
+	"gzip": [1, 6, 9],
+	"zstd": [1, 3, 9, 19],
+}
+
+def load_events(path):
+	text = sys.stdin.read() if path == "-" else Path(path).read_text()
+
+	if text.lstrip().startswith("["):
+		return json.loads(text)
+
+	return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print("Usage: bench-codecs.py EVENTS.(json|ndjson)|- [BATCH_SIZE]")
+
+		sys.exit(1)
+
+	events = load_events(sys.argv[1])
+	batch = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+	# Benchmark the batch size the agent would actually send.
+	payload = events[:batch]
+
+	print(f"{len(payload)} events per batch (of {len(events)} loaded)\n")
+	print(f"{'format':<9} {'codec':<22} {'bytes':>10} {'B/event':>9} {'us/event':>9}")
+
+	rows = codec.benchmark(payload, levels=LEVELS)
+
+	for row in sorted(rows, key=lambda r: r["bytes"]):
+		name = f"{row['serializer']}+{row['compression']}"
+
+		if row["level"] is not None:
+			name = f"{name}:{row['level']}"
+
+		print(
+			f"{row['format']:<9} "
+			f"{name:<22} "
+			f"{row['bytes']:>10} "
+			f"{row['bytes_per_event']:>9.1f} "
+			f"{row['us_per_event']:>9.2f}"
+		)
+
+	missing = [
+		name for name, cls in {**codec.SERIALIZERS, **codec.COMPRESSORS}.items()
+		if not codec.available(cls)
+	]
+
+	if missing:
+		print(f"\nNot installed (skipped): {', '.join(missing)}")
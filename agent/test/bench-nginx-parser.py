@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Measures NginxParser throughput (lines/sec), before (an uncached strptime per line) and after
+# (the cached timestamp conversion); for example:
+#
+#   agent/test/bench-nginx-parser.py /var/log/nginx/access.log
+#   agent/test/bench-nginx-parser.py - 200000 < access.log
+#
+# Without a file, synthetic combined format lines are used. The results of both are also checked
+# against each other.
+
+import sys
+import time
+import random
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# Always append the "project root" (setup as `ROOT` here) so that the main Python code is found.
+sys.path.insert(0, str(ROOT))
+
+from massaffect.collector.log import NginxParser, _time_local
+
+class BaselineParser(NginxParser):
+	"""NginxParser.parse as it was: the regex, and strptime for every line."""
+
+	def parse(self, line):
+		m = self.NGINX_RE.match(line)
+
+		if not m:
+			return None
+
+		data = m.groupdict()
+
+		data["status"] = int(data["status"])
+		data["body_bytes_sent"] = (
+			int(data["body_bytes_sent"])
+			if data["body_bytes_sent"].isdigit() else 0
+		)
+
+		tl = data.get("time_local")
+
+		if tl:
+			try:
+				data["time_local"] = datetime.strptime(
+					tl,
+					"%d/%b/%Y:%H:%M:%S %z"
+				).astimezone(timezone.utc).isoformat()
+
+			except Exception:
+				data["time_local"] = None
+
+		if data["request"]:
+			parts = data["request"].split()
+
+			if len(parts) == 3:
+				data["method"], data["path"], data["protocol"] = parts
+
+		return data
+
+def synthetic(count):
+	"""Roughly 20 lines per second of log, with the odd outer-quoted or extended line."""
+
+	start = datetime(2026, 3, 1, 4, 0, 0, tzinfo=timezone(timedelta(hours=-5)))
+	lines = []
+
+	for i in range(count):
+		ts = (start + timedelta(seconds=i // 20)).strftime("%d/%b/%Y:%H:%M:%S %z")
+		line = (
+			f"192.168.{i % 7}.{i % 251} - - [{ts}] "
+			f'"{random.choice(["GET", "POST"])} /page/{i % 113}?q={i} HTTP/1.1" '
+			f'{random.choice([200, 200, 301, 404])} {random.choice(["-", str(i % 9000)])} '
+			f'"https://example.com/" "Mozilla/5.0 (X11; Linux x86_64) Firefox/{i % 30}.0"'
+		)
+
+		if i % 50 == 0:
+			line = f'"{line}"'
+
+		elif i % 50 == 1:
+			line = f"{line} rt=0.{i % 1000:03d}"
+
+		lines.append(line)
+
+	return lines
+
+def bench(parser, lines):
+	start = time.perf_counter()
+	results = [parser.parse(line) for line in lines]
+
+	return len(lines) / (time.perf_counter() - start), results
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] != "-":
+		lines = Path(sys.argv[1]).read_text(errors="replace").splitlines()
+
+	elif len(sys.argv) > 1:
+		lines = sys.stdin.read().splitlines()
+
+	else:
+		lines = synthetic(200000)
+
+	if len(sys.argv) > 2:
+		lines = lines[:int(sys.argv[2])]
+
+	print(f"{len(lines)} lines\n")
+	print(f"{'parser':<24} {'lines/sec':>12} {'speedup':>8}")
+
+	variants = {
+		"strptime (before)": BaselineParser(),
+		"cached": NginxParser(),
+	}
+
+	base = None
+	expected = None
+
+	for name, parser in variants.items():
+		_time_local.cache_clear()
+
+		rate, results = bench(parser, lines)
+		base = base or rate
+
+		print(f"{name:<24} {rate:>12,.0f} {rate / base:>7.2f}x")
+
+		if expected is None:
+			expected = results
+
+		elif results != expected:
+			mismatches = sum(a != b for a, b in zip(results, expected))
+
+			print(f"  {mismatches} lines parsed differently from the baseline!")
+
+			sys.exit(1)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Writes synthetic "wordpress" events into the agent's shared-memory ring buffer (see
+# `[agent.shm]`) as fast as possible, reporting the rate; for example:
+#
+#   agent/test/generate-shm-event.py /dev/shm/massaffect.ring 100000 50 [exclusive]
+#
+# The third argument is the number of events written per lock (`RingProducer.write_many`); with
+# "exclusive", the ring is claimed once, and written without locking at all.
+
+import sys
+import json
+import time
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# Always append the "project root" (setup as `ROOT` here) so that the main Python code is found.
+sys.path.insert(0, str(ROOT))
+
+from massaffect.shmring import RingProducer
+
+def main():
+	if len(sys.argv) < 2:
+		print("Usage: generate-shm-event.py <ring> [count] [batch] [exclusive]")
+
+		sys.exit(1)
+
+	ring = RingProducer(sys.argv[1], exclusive=sys.argv[4:5] == ["exclusive"])
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+	batch = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+	written = 0
+	start = time.perf_counter()
+
+	for i in range(0, count, batch):
+		frames = [
+			json.dumps({
+				"collector": "wordpress",
+				"site": "example.com",
+				"ts": int(time.time()),
+				"metrics": {
+					"request_time_ms": 100 + n % 50,
+					"db_queries": n % 20,
+				}
+			}).encode()
+			for n in range(i, min(i + batch, count))
+		]
+
+		written += ring.write_many(frames)
+
+	elapsed = time.perf_counter() - start
+
+	print(f"Wrote {written}/{count} events in {elapsed:.3f}s ({count / elapsed:.0f}/s)")
+
+	ring.close()
+
+if __name__ == "__main__":
+	main()
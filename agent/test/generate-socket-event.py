@@ -60,9 +60,39 @@ def send_batch():
 
 	print("Sent batch of 2 events")
 
+def send_stream(count=1000):
+	"""
+	Sends `count` events as NDJSON over a single connection, reading the ack byte after each
+	one (requires `[agent.socket] ack = true`).
+	"""
+
+	acks = {}
+
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+		client.connect(SOCKET_PATH)
+
+		for i in range(count):
+			payload = {
+				"collector": "wordpress",
+				"site": "example.com",
+				"ts": int(time.time()),
+				"metrics": {
+					"request_time_ms": 100 + i % 50,
+					"db_queries": i % 20,
+				}
+			}
+
+			client.sendall(json.dumps(payload).encode() + b"\n")
+
+			ack = client.recv(1).decode()
+
+			acks[ack] = acks.get(ack, 0) + 1
+
+	print(f"Sent {count} events over one connection; acks: {acks}")
+
 if __name__ == "__main__":
 	if len(sys.argv) < 2:
-		print("Usage: socket_test.py single|batch")
+		print("Usage: socket_test.py single|batch|stream")
 
 		sys.exit(1)
 
@@ -74,5 +104,8 @@ if __name__ == "__main__":
 	elif mode == "batch":
 		send_batch()
 
+	elif mode == "stream":
+		send_stream()
+
 	else:
 		print("Unknown mode")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Tests for LogCollector's pattern expansion and rotation; run with:
+#
+#   python -m pytest agent/test/test_log_collector.py
+
+import shutil
+import sys
+
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# Always append the "project root" (setup as `ROOT` here) so that the main Python code is found.
+sys.path.insert(0, str(ROOT))
+
+from massaffect.collector.log import LogCollector
+
+def touch(path):
+	path.parent.mkdir(parents=True, exist_ok=True)
+	path.write_text("line\n")
+
+	return path
+
+def collector(tmp_path, *patterns, **kwargs):
+	return LogCollector(patterns=list(patterns), state_file=str(tmp_path / "state.json"), **kwargs)
+
+def write(path, *lines, mode="a"):
+	with open(path, mode) as f:
+		f.writelines(f"{line}\n" for line in lines)
+
+def test_recursive_pattern(tmp_path):
+	expected = {
+		touch(tmp_path / "logs" / "top.log"),
+		touch(tmp_path / "logs" / "a" / "y.log"),
+		touch(tmp_path / "logs" / "a" / "b" / "x.log"),
+		touch(tmp_path / "logs" / ".hidden" / "z.log"),
+	}
+
+	touch(tmp_path / "logs" / "a" / "b" / "x.txt")
+
+	c = collector(tmp_path, f"{tmp_path}/logs/**/*.log")
+
+	assert set(c.paths()) == expected
+	assert set(c.paths()) == set(Path("/").glob(f"{tmp_path}/logs/**/*.log".lstrip("/")))
+
+def test_relative_pattern_is_anchored_at_root(tmp_path, monkeypatch):
+	log = touch(tmp_path / "access.log")
+
+	monkeypatch.chdir(tmp_path)
+
+	c = collector(tmp_path, f"{str(tmp_path).lstrip('/')}/*.log", "*.log")
+
+	assert c.paths() == [log]
+
+def test_directory_matching_several_patterns(tmp_path):
+	access = touch(tmp_path / "access.log")
+	error = touch(tmp_path / "error.log")
+
+	touch(tmp_path / "other.log")
+
+	c = collector(tmp_path, f"{tmp_path}/access.log", f"{tmp_path}/err*.log")
+
+	assert c.paths() == [access, error]
+
+@pytest.mark.parametrize("copytruncate", [True, False])
+def test_rotation_drained_across_budgets(tmp_path, copytruncate):
+	log = tmp_path / "access.log"
+
+	write(log, "l0", "l1", "l2", "l3", "l4", "l5", "l6")
+
+	c = collector(tmp_path, str(log), file_budget={"lines": 3})
+
+	assert [e["raw"] for e in c.collect()] == ["l0", "l1", "l2"]
+
+	if copytruncate:
+		shutil.copy(log, f"{log}.1")
+
+	else:
+		log.rename(f"{log}.1")
+
+	write(log, "n0", "n1", mode="w")
+
+	lines = []
+
+	for _ in range(10):
+		lines += [e["raw"] for e in c.collect()]
+
+		if not c.backlog:
+			break
+
+	assert lines == ["l3", "l4", "l5", "l6", "n0", "n1"]
+	assert not c.backlog
+
+	write(log, "n2")
+
+	assert [e["raw"] for e in c.collect()] == ["n2"]
+
+if __name__ == "__main__":
+	sys.exit(pytest.main([__file__, "-q"]))
@@ -40,3 +40,56 @@ export const Events = {
 	getEvents,
 	getLogEvents
 };
+
+// The agent's optional columnar batch format (see massaffect/columnar.py), advertised in the
+// `x-batch-format` header.
+const COLUMNAR_FORMAT = "columnar/1";
+
+function decodeColumns(columns, count) {
+	const rows = Array.from({ length: count }, () => ({}));
+
+	for(const [key, column] of Object.entries(columns)) {
+		const absent = new Set(column.absent || []);
+		const values = column.dict ? column.index.map(i => column.dict[i]) : column.values;
+
+		if(!Array.isArray(values) || values.length !== count) {
+			throw new Error(`Column '${key}' doesn't have ${count} values`);
+		}
+
+		values.forEach((value, i) => {
+			if(!absent.has(i)) rows[i][key] = value;
+		});
+	}
+
+	return rows;
+}
+
+// Converts a columnar batch back into its list of events; throws on a malformed one.
+function decodeColumnar(doc) {
+	if(doc?.format !== COLUMNAR_FORMAT || !Array.isArray(doc.groups)) {
+		throw new Error(`Unsupported batch format: ${doc?.format}`);
+	}
+
+	const events = [];
+
+	for(const group of doc.groups) {
+		const fields = decodeColumns(group.fields, group.count);
+
+		if(group.metrics) {
+			decodeColumns(group.metrics, group.count).forEach((m, i) => {
+				fields[i].metrics = m;
+			});
+		}
+
+		for(const f of fields) {
+			events.push(group.collector === null ? f : { collector: group.collector, ...f });
+		}
+	}
+
+	return events;
+}
+
+export const Batch = {
+	COLUMNAR_FORMAT,
+	decodeColumnar
+};
@@ -47,6 +47,11 @@ export function verifyIP(req, res, next) {
 export function verifyHMAC(req, res, next) {
     const signature = req.headers["x-agent-signature"];
 
+    // Not a body that was parsed (see middleware/body.js), so there's nothing to check.
+    if(!req.rawBody) {
+        return res.status(415).json({ error: "Unsupported request body" });
+    }
+
     const expected = crypto
         .createHmac("sha256", cfg().agent.agent_secret)
         .update(req.rawBody)   // ← THIS IS THE FIX
@@ -0,0 +1,81 @@
+import express from "express";
+
+import { decode as msgpackDecode } from "@msgpack/msgpack";
+import { decompress as zstdDecompress } from "fzstd";
+
+// Parses request bodies as the agent sends them (see massaffect/codec.py): JSON or msgpack, either
+// of them optionally gzip or zstd compressed. The agent signs the uncompressed body, which is kept
+// as `req.rawBody` for `verifyHMAC`.
+
+const LIMIT = 50 * 1024 * 1024;
+
+const MSGPACK = "application/msgpack";
+
+function keepRawBody(req, res, buf) {
+	req.rawBody = buf;
+}
+
+function decode(req, buf) {
+	return req.is(MSGPACK) ? msgpackDecode(buf) : JSON.parse(buf.toString("utf8"));
+}
+
+// body-parser doesn't know zstd (and answers 415), so those bodies are read and decoded here;
+// the parsers below then skip the request, as it's already been read.
+async function zstdBody(req, res, next) {
+	if(req.get("content-encoding")?.toLowerCase() !== "zstd") return next();
+
+	const chunks = [];
+	let size = 0;
+
+	for await(const chunk of req) {
+		size += chunk.length;
+
+		if(size > LIMIT) return res.status(413).json({ error: "Request body too large" });
+
+		chunks.push(chunk);
+	}
+
+	try {
+		req.rawBody = Buffer.from(zstdDecompress(Buffer.concat(chunks)));
+	}
+
+	catch(err) {
+		return res.status(400).json({ error: `Bad zstd body: ${err.message}` });
+	}
+
+	if(req.rawBody.length > LIMIT) return res.status(413).json({ error: "Request body too large" });
+
+	try {
+		req.body = decode(req, req.rawBody);
+	}
+
+	catch(err) {
+		return res.status(400).json({ error: `Bad request body: ${err.message}` });
+	}
+
+	req._body = true;
+
+	next();
+}
+
+// `express.raw` leaves msgpack bodies (after gunzipping them) as a Buffer.
+function msgpackBody(req, res, next) {
+	if(!Buffer.isBuffer(req.body) || !req.is(MSGPACK)) return next();
+
+	try {
+		req.body = msgpackDecode(req.body);
+	}
+
+	catch(err) {
+		return res.status(400).json({ error: `Bad msgpack body: ${err.message}` });
+	}
+
+	next();
+}
+
+export const parseBody = [
+	zstdBody,
+	express.json({ verify: keepRawBody, limit: LIMIT }),
+	express.raw({ type: MSGPACK, verify: keepRawBody, limit: LIMIT }),
+	msgpackBody
+];
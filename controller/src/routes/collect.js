@@ -5,6 +5,7 @@ import path from "node:path";
 import { cfg } from "../config.js";
 import { verifyIP, verifyHMAC } from "../middleware/auth.js";
 import { getClients } from "../state/clients.js";
+import { Batch } from "../lib.js";
 
 export default function collectRoutes(redis, pg) {
 	const router = express.Router();
@@ -12,7 +13,23 @@ export default function collectRoutes(redis, pg) {
 	router.use(verifyIP);
 
 	router.post("/", verifyHMAC, async(req, res) => {
-		const events = Array.isArray(req.body) ? req.body : [req.body];
+		const format = req.get("x-batch-format");
+		let events = Array.isArray(req.body) ? req.body : [req.body];
+
+		if(format) {
+			if(format !== Batch.COLUMNAR_FORMAT) {
+				return res.status(415).json({ error: `Unsupported batch format: ${format}` });
+			}
+
+			try {
+				events = Batch.decodeColumnar(req.body);
+			}
+
+			catch(err) {
+				return res.status(400).json({ error: `Bad columnar batch: ${err.message}` });
+			}
+		}
+
 		const ip = req.ip.replace("::ffff:", "");
 		const hostname = cfg().controller.agents[ip];
 
@@ -6,6 +6,7 @@ import { createClient } from 'redis';
 import { Pool } from "pg";
 
 import { cfg } from "./config.js";
+import { parseBody } from "./middleware/body.js";
 
 const config = cfg();
 
@@ -44,10 +45,8 @@ app.set("view engine", "ejs");
 app.set("views", path.join(process.cwd(), "views"));
 
 // app.use(express.json({ limit: "50mb" }));
-app.use(express.json({
-    verify: (req, res, buf) => { req.rawBody = buf; },
-	limit: "50mb"
-}));
+// JSON or msgpack, optionally gzip/zstd compressed; see middleware/body.js.
+app.use(parseBody);
 app.use(morgan("dev"));
 
 /* import monitorRoutes from "./routes/monitor.js";
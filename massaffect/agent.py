@@ -1,13 +1,21 @@
 import os
 import asyncio
+import socket
+import struct
 import logging
-import json
 import time
 
 from . import config, create_collectors
 from . import application
 from . import transport
 from . import dispatch
+from . import spool
+from . import ingest
+from . import codec
+from . import ratelimit
+from . import shmring
+
+from .collector.agent import AgentCollector
 
 logging.basicConfig(
 	level=logging.DEBUG,
@@ -19,81 +27,356 @@ class Agent(application.Application):
 		super().__init__()
 
 		self.collectors = create_collectors()
-		self.transport = transport.DebugPrettyTransport()
-		# self.transport = transport.HTTPTransport()
-		self.dispatcher = dispatch.Dispatcher(self.transport, config().agent.interval)
+
+		if config().agent.delta.enabled:
+			self.log.warning(
+				"Delta mode is enabled; the receiving end must apply the deltas (the bundled "
+				"controller doesn't)"
+			)
+
+			for c in self.collectors:
+				if c.DELTA:
+					c.enable_delta(
+						config().agent.delta.keyframe_interval,
+						config().agent.delta.tolerance
+					)
+
+		if config().agent.watch.enabled:
+			for c in self.collectors:
+				if c.WATCH:
+					c.enable_watch(config().agent.watch.debounce)
+
+		self.transport = transport.TRANSPORTS[config().agent.transport]()
+		self.spool = None
+
+		if config().agent.spool.path:
+			self.spool = spool.Spool(
+				config().agent.spool.path,
+				max_bytes=config().agent.spool.max_bytes,
+				segment_bytes=config().agent.spool.segment_bytes,
+				fsync_batches=config().agent.spool.fsync_batches,
+				fsync_interval=config().agent.spool.fsync_interval
+			)
+
+		self.dispatcher = dispatch.Dispatcher(
+			self.transport,
+			config().agent.interval,
+			max_events=config().agent.queue.max_events,
+			max_bytes=config().agent.queue.max_bytes,
+			policy=config().agent.queue.policy,
+			priorities=config().agent.queue.priorities,
+			batch_max_events=config().agent.flush.batch_max_events,
+			batch_max_bytes=config().agent.flush.batch_max_bytes,
+			max_age=config().agent.flush.max_age,
+			spool=self.spool,
+			max_in_flight=config().agent.flush.max_in_flight,
+			ordered=config().agent.flush.ordered,
+			lanes=config().agent.lanes,
+			warm_ahead=config().agent.http.warm_ahead
+		)
 		self.server = None
+		self.decoder = codec.JSONSerializer()
+		self.datagrams = None
+
+		if config().agent.socket.dgram_name:
+			self.datagrams = ingest.DatagramReceiver(config().agent.socket.dgram_max_pending)
+
+		self.ring = None
+
+		if config().agent.shm.path:
+			self.ring = shmring.RingConsumer(
+				config().agent.shm.path,
+				config().agent.shm.size,
+				config().agent.shm.mode
+			)
+
+		self.limiter = ratelimit.RateLimiter(
+			rate=config().agent.limits.rate,
+			burst=config().agent.limits.burst,
+			per_peer=config().agent.limits.per_peer,
+			overflow=config().agent.limits.overflow,
+			collectors=config().agent.limits.collectors
+		)
+
+		if not self.limiter.enabled:
+			self.limiter = None
+
+		sources = {
+			"dispatch": self.dispatcher,
+			"transport": self.transport,
+		}
+
+		if self.spool:
+			sources["spool"] = self.spool
+
+		if self.datagrams:
+			sources["datagrams"] = self.datagrams
+
+		if self.ring:
+			sources["shm"] = self.ring
+
+		if self.limiter:
+			sources["limits"] = self.limiter
+
+		# Collectors reporting on themselves (e.g. LogCollector's lag).
+		for i, c in enumerate(self.collectors):
+			if hasattr(c, "stats"):
+				sources[c.name if c.name not in sources else f"{c.name}.{i}"] = c
+
+		self.collectors.append(AgentCollector(sources))
+
+	def _valid(self, item):
+		if not isinstance(item, dict):
+			self.log.warning("Non-object JSON received")
+
+			return False
+
+		if "collector" not in item:
+			self.log.warning("Missing 'collector' field")
+
+			return False
+
+		# Used as a key (and matched against patterns) by the dispatcher and the rate limits.
+		if not isinstance(item["collector"], str):
+			self.log.warning("Non-string 'collector' field")
+
+			return False
+
+		return True
+
+	def _allow(self, collector, uid):
+		return self.limiter is None or self.limiter.allow(collector, uid)
+
+	async def _accept_line(self, line, uid=None):
+		"""
+		Decodes one line (an event object, or a list of them) and enqueues its events; returns
+		the ack byte for it. A single event is queued as a `RawEvent`, so its bytes go out as
+		they came in, rather than being re-encoded. Events over their rate limit (see
+		`[agent.limits]`; `uid` is the producer's, if known) are dropped.
+		"""
+
+		line = line.strip()
 
-	async def handle_socket(self, reader, writer):
 		try:
-			data = await reader.read()
+			payload = self.decoder.decode(line)
 
-			if not data:
-				return
+		except ValueError:
+			self.log.warning("Invalid JSON received")
 
-			try:
-				payload = json.loads(data.decode())
+			return b"-"
 
-			except json.JSONDecodeError:
-				self.log.warning("Invalid JSON received")
+		if isinstance(payload, dict):
+			if not self._valid(payload):
+				return b"-"
 
-				return
+			if not self._allow(payload["collector"], uid):
+				return b"!"
 
-			# Normalize to list
-			if not isinstance(payload, list):
-				payload = [payload]
+			event = codec.RawEvent(line, payload["collector"])
 
-			for item in payload:
-				if not isinstance(item, dict):
-					self.log.warning("Non-object JSON received")
+			return b"+" if await self.dispatcher.enqueue(event) else b"!"
 
-					continue
+		if not isinstance(payload, list):
+			payload = [payload]
 
-				if "collector" not in item:
-					self.log.warning("Missing 'collector' field")
+		items = [item for item in payload if self._valid(item)]
 
+		if not items:
+			return b"-"
+
+		allowed = [item for item in items if self._allow(item["collector"], uid)]
+
+		if await self.dispatcher.enqueue_many(allowed) == len(items):
+			return b"+"
+
+		return b"!"
+
+	@staticmethod
+	def _peer_uid(writer):
+		"""The uid of the process at the other end of a stream connection (or None)."""
+
+		sock = writer.get_extra_info("socket")
+		creds = struct.Struct("3i")
+
+		try:
+			_, uid, _ = creds.unpack(
+				sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size)
+			)
+
+		except (AttributeError, OSError):
+			return None
+
+		return uid
+
+	async def handle_socket(self, reader, writer):
+		"""
+		Reads newline-delimited JSON from a producer; the connection may stay open for any number
+		of lines, or carry a single document (with or without the newline) and be closed. With
+		`[agent.socket] ack` enabled, every line is answered with a single byte (see
+		`_accept_line`), which a producer can use to back off.
+		"""
+
+		ack = config().agent.socket.ack
+		lines = 0
+		uid = None
+
+		if self.limiter and self.limiter.per_peer:
+			uid = self._peer_uid(writer)
+
+		try:
+			while True:
+				try:
+					line = await reader.readline()
+
+				except ValueError:
+					self.log.warning(
+						f"Socket line exceeds {config().agent.socket.max_line} bytes; disconnecting"
+					)
+
+					break
+
+				if not line:
+					break
+
+				if not line.strip():
 					continue
 
-				await self.dispatcher.enqueue(item)
+				status = await self._accept_line(line, uid)
+
+				lines += 1
+
+				if ack:
+					writer.write(status)
 
-			self.log.info("Socket payload accepted")
+					await writer.drain()
+
+		except ConnectionError:
+			pass
 
 		except Exception as e:
 			self.log.warning(f"Socket error: {e}")
 
 		finally:
+			self.log.debug(f"Socket connection closed after {lines} line(s)")
+
 			writer.close()
 
-			await writer.wait_closed()
+			try:
+				await writer.wait_closed()
 
-	async def handle_collector(self):
+			except ConnectionError:
+				pass
+
+	async def _accept_frame(self, data, counters):
 		"""
-		Periodically runs collectors and enqueues their payloads.
+		Accepts a datagram or ring frame, counting (in `counters`) those that are invalid or fail;
+		a bad one is dropped, rather than ending the task reading them.
 		"""
 
-		def _build_event(collector_name, metrics):
-			return {
-				"collector": collector_name,
-				"ts": int(time.time()),
-				"metrics": metrics
-			}
+		try:
+			status = await self._accept_line(data)
+
+		except Exception as e:
+			self.log.warning(f"Error accepting event: {e!r}")
+
+			counters["errors"] += 1
+
+			return
+
+		if status == b"-":
+			counters["invalid"] += 1
+
+	async def _accept_datagrams(self, batch):
+		for data in batch:
+			await self._accept_frame(data, self.datagrams.counters)
+
+	async def handle_datagrams(self):
+		async for batch in self.datagrams.batches():
+			await self._accept_datagrams(batch)
+
+	async def handle_ring(self):
+		"""
+		Drains the shared-memory ring buffer; polled, since producers can't signal the agent
+		without a syscall.
+		"""
+
+		max_frames = config().agent.shm.max_frames
 
 		while self.running:
-			for c in self.collectors:
-				try:
-					count = 0
+			frames = self.ring.read(max_frames)
+
+			for data in frames:
+				await self._accept_frame(data, self.ring.counters)
 
-					for metrics in c.collect():
-						payload = _build_event(c.name, metrics)
+			if len(frames) < max_frames:
+				await asyncio.sleep(config().agent.shm.poll_interval)
 
-						await self.dispatcher.enqueue(payload)
+			else:
+				# A full ring; drain it as fast as possible, but let other tasks run.
+				await asyncio.sleep(0)
 
-						count += 1
+	async def handle_suppressed(self):
+		"""
+		Once per interval, reports (and with the "summarize" overflow policy, enqueues a single
+		"suppressed" event counting) the socket events dropped by the rate limits.
+		"""
 
-					self.log.info(f"{c}: queued {count} events")
+		while self.running:
+			try:
+				await self.wait_shutdown(config().agent.interval)
+
+			except asyncio.TimeoutError:
+				pass
+
+			metrics = self.limiter.summary()
+
+			if metrics and self.limiter.overflow == "summarize":
+				await self.dispatcher.enqueue({
+					"collector": "suppressed",
+					"ts": int(time.time()),
+					"metrics": metrics
+				})
+
+	async def _collect(self, c):
+		"""
+		Runs a single collector, enqueueing its payloads.
+		"""
+
+		if c.name in self.transport.resync:
+			self.transport.resync.discard(c.name)
+
+			c.resync()
+
+		try:
+			count = 0
 
-				except Exception as e:
-					self.log.warning(f"{c}: collect failed: {e}")
+			for metrics in c.collect():
+				payload = {
+					"collector": c.name,
+					"ts": int(time.time()),
+					"metrics": metrics
+				}
+
+				await self.dispatcher.enqueue(payload)
+
+				count += 1
+
+			# Watched collectors also run whenever an unrelated file changes.
+			if count or not c.watcher:
+				self.log.info(f"{c}: queued {count} events")
+
+		except Exception as e:
+			self.log.warning(f"{c}: collect failed: {e}")
+
+	async def handle_collector(self):
+		"""
+		Periodically runs (the unwatched) collectors and enqueues their payloads.
+		"""
+
+		while self.running:
+			for c in self.collectors:
+				if not c.watcher:
+					await self._collect(c)
 
 			try:
 				await self.wait_shutdown(config().agent.interval)
@@ -101,6 +384,21 @@ class Agent(application.Application):
 			except asyncio.TimeoutError:
 				pass
 
+	async def handle_watched(self, c):
+		"""
+		Runs a watched collector whenever it has something new (or at least every interval).
+		"""
+
+		while self.running:
+			await self._collect(c)
+
+			# Letting everything else run before carrying on.
+			if c.backlog:
+				await asyncio.sleep(0)
+
+			else:
+				await c.wait(config().agent.interval)
+
 	async def startup(self):
 		self.log.info("Starting")
 
@@ -112,11 +410,18 @@ class Agent(application.Application):
 
 		self.server = await asyncio.start_unix_server(
 			self.handle_socket,
-			path=socket_name
+			path=socket_name,
+			limit=config().agent.socket.max_line
 		)
 
 		self.log.debug(f"Created socket: {socket_name.replace(chr(0), '@')}")
 
+		if self.datagrams:
+			await self.datagrams.start(
+				config().agent.socket.dgram_name,
+				config().agent.socket.dgram_rcvbuf
+			)
+
 		for c in self.collectors:
 			await c.start()
 
@@ -124,10 +429,24 @@ class Agent(application.Application):
 	def tasks(self):
 		t = [
 			self.dispatcher.run(),
+			self.dispatcher.replay(),
 			self.server.serve_forever(),
 			self.handle_collector()
 		]
 
+		if self.datagrams:
+			t.append(self.handle_datagrams())
+
+		if self.ring:
+			t.append(self.handle_ring())
+
+		for c in self.collectors:
+			if c.watcher:
+				t.append(self.handle_watched(c))
+
+		if self.limiter:
+			t.append(self.handle_suppressed())
+
 		for c in self.collectors:
 			t.extend(c.tasks)
 
@@ -139,9 +458,22 @@ class Agent(application.Application):
 
 			await self.server.wait_closed()
 
-		await self.dispatcher.close()
+		if self.datagrams:
+			self.datagrams.close()
+
+			# Whatever was received but not yet handed over by `handle_datagrams`.
+			await self._accept_datagrams(self.datagrams.take())
+
+		await self.dispatcher.close(config().agent.spool.shutdown_timeout)
 		await self.transport.close()
 
+		for c in self.collectors:
+			await c.stop()
+
+		# Unread frames stay in the ring, for the next run.
+		if self.ring:
+			self.ring.close()
+
 async def main():
 	agent = Agent()
 
@@ -0,0 +1,321 @@
+import json
+import time
+import zlib
+
+from . import columnar
+
+try:
+	import orjson
+
+except ModuleNotFoundError:
+	orjson = None
+
+try:
+	import msgpack
+
+except ModuleNotFoundError:
+	msgpack = None
+
+try:
+	import zstandard
+
+except ModuleNotFoundError:
+	zstandard = None
+
+# ================================================================================================
+# Pass-through events
+
+class RawEvent:
+	"""
+	An event received from a producer as a (validated) JSON object, kept as its original bytes;
+	JSON batches (and the spool) splice `data` in as-is, instead of decoding and re-encoding it.
+	Only `collector` is kept decoded; anything else needing the event's fields (`get`, `[]`)
+	decodes `data` once, on demand.
+	"""
+
+	__slots__ = ("data", "collector", "_event")
+
+	def __init__(self, data, collector):
+		self.data = data
+		self.collector = collector
+
+		self._event = None
+
+	@property
+	def event(self):
+		if self._event is None:
+			self._event = orjson.loads(self.data) if orjson else json.loads(self.data)
+
+		return self._event
+
+	def get(self, key, default=None):
+		if key == "collector":
+			return self.collector
+
+		return self.event.get(key, default)
+
+	def __getitem__(self, key):
+		return self.event[key]
+
+	def __contains__(self, key):
+		return key in self.event
+
+	def __repr__(self):
+		return f"RawEvent({self.data!r})"
+
+def materialize(payload):
+	"""Returns `payload` (a list of events) with every `RawEvent` decoded."""
+
+	return [e.event if isinstance(e, RawEvent) else e for e in payload]
+
+def json_event(event, dumps):
+	"""The JSON bytes of `event`; a `RawEvent`'s own, or `dumps(event)`."""
+
+	return event.data if isinstance(event, RawEvent) else dumps(event)
+
+# ================================================================================================
+# Serializers
+#
+# A serializer turns a batch (list of events) into a stream of byte chunks; each event is
+# encoded on its own, so the full document never needs to exist as a single object.
+
+class Serializer:
+	NAME = ""
+	CONTENT_TYPE = ""
+
+	def chunks(self, payload, chunk_size):
+		raise NotImplementedError
+
+	def dumps(self, obj):
+		raise NotImplementedError
+
+	def decode(self, data):
+		raise NotImplementedError
+
+def _reject_constant(name):
+	raise ValueError(f"{name} is not valid JSON")
+
+class StdJSONSerializer(Serializer):
+	"""The stdlib `json` module; compact separators, non-ASCII escaped."""
+
+	NAME = "stdjson"
+	CONTENT_TYPE = "application/json"
+
+	def dumps(self, obj):
+		return json.dumps(obj, separators=(",", ":")).encode()
+
+	def chunks(self, payload, chunk_size):
+		parts = [b"["]
+		size = 1
+
+		for i, event in enumerate(payload):
+			data = json_event(event, self.dumps)
+
+			if i:
+				parts.append(b",")
+
+			parts.append(data)
+
+			size += len(data) + 1
+
+			if size >= chunk_size:
+				yield b"".join(parts)
+
+				parts = []
+				size = 0
+
+		parts.append(b"]")
+
+		yield b"".join(parts)
+
+	def decode(self, data):
+		return json.loads(data)
+
+class JSONSerializer(StdJSONSerializer):
+	"""Uses `orjson` when it's installed (several times faster), otherwise the stdlib."""
+
+	NAME = "json"
+
+	def dumps(self, obj):
+		if orjson is None:
+			return super().dumps(obj)
+
+		return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+	def decode(self, data):
+		"""
+		Parses strict JSON: NaN and (-)Infinity are rejected (as orjson does), since decoded
+		events may be passed on verbatim, and receivers' parsers don't accept them.
+		"""
+
+		if orjson:
+			return orjson.loads(data)
+
+		return json.loads(data, parse_constant=_reject_constant)
+
+class MsgpackSerializer(Serializer):
+	NAME = "msgpack"
+	CONTENT_TYPE = "application/msgpack"
+	REQUIRES = msgpack
+
+	def chunks(self, payload, chunk_size):
+		packer = msgpack.Packer()
+		parts = [packer.pack_array_header(len(payload))]
+		size = 0
+
+		for event in materialize(payload):
+			data = packer.pack(event)
+
+			parts.append(data)
+
+			size += len(data)
+
+			if size >= chunk_size:
+				yield b"".join(parts)
+
+				parts = []
+				size = 0
+
+		yield b"".join(parts)
+
+	def dumps(self, obj):
+		return msgpack.packb(obj)
+
+	def decode(self, data):
+		return msgpack.unpackb(data)
+
+# ================================================================================================
+# Compressors
+#
+# A compressor returns a new streaming "compressobj" (with `compress` and `flush` methods) for
+# every body; `ENCODING` is what's advertised in the `Content-Encoding` header.
+
+class Compressor:
+	NAME = ""
+	ENCODING = None
+	DEFAULT_LEVEL = None
+
+	def __init__(self, level=None):
+		self.level = self.DEFAULT_LEVEL if level is None else level
+
+	def compressobj(self):
+		raise NotImplementedError
+
+	def decompress(self, data):
+		raise NotImplementedError
+
+class NoCompressor(Compressor):
+	NAME = "none"
+
+	def compressobj(self):
+		return None
+
+	def decompress(self, data):
+		return data
+
+class GzipCompressor(Compressor):
+	NAME = "gzip"
+	ENCODING = "gzip"
+	DEFAULT_LEVEL = 6
+
+	def compressobj(self):
+		# The gzip container format, like `gzip.compress`.
+		return zlib.compressobj(self.level, wbits=31)
+
+	def decompress(self, data):
+		return zlib.decompress(data, wbits=31)
+
+class ZstdCompressor(Compressor):
+	NAME = "zstd"
+	ENCODING = "zstd"
+	DEFAULT_LEVEL = 3
+	REQUIRES = zstandard
+
+	def compressobj(self):
+		return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+	def decompress(self, data):
+		return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+SERIALIZERS = {cls.NAME: cls for cls in (JSONSerializer, StdJSONSerializer, MsgpackSerializer)}
+COMPRESSORS = {cls.NAME: cls for cls in (NoCompressor, GzipCompressor, ZstdCompressor)}
+
+def available(cls):
+	"""Returns False if `cls` depends on an optional module that isn't installed."""
+
+	return getattr(cls, "REQUIRES", True) is not None
+
+# ================================================================================================
+# Benchmarking
+
+def _body(serializer, payload, batch_format):
+	if batch_format == "columnar":
+		return [serializer.dumps(columnar.encode_batch(materialize(payload)))]
+
+	return serializer.chunks(payload, 64 * 1024)
+
+def benchmark(
+	payload,
+	serializers=None,
+	compressors=None,
+	levels=None,
+	formats=("rows", "columnar"),
+	repeat=3
+):
+	"""
+	Encodes `payload` (a list of events) with every (available) batch format, serializer,
+	compressor and level combination, returning one row per combination with the encoded size
+	and the CPU time spent, per event. Use `agent/test/bench-codecs.py` to run this against
+	real payloads.
+	"""
+
+	rows = []
+	count = max(len(payload), 1)
+
+	for batch_format, s_name in ((f, s) for f in formats for s in serializers or SERIALIZERS):
+		s_cls = SERIALIZERS[s_name]
+
+		if not available(s_cls):
+			continue
+
+		serializer = s_cls()
+
+		for c_name in compressors or COMPRESSORS:
+			c_cls = COMPRESSORS[c_name]
+
+			if not available(c_cls):
+				continue
+
+			for level in (levels or {}).get(c_name, [c_cls.DEFAULT_LEVEL]):
+				compressor = c_cls(level)
+				best = None
+
+				for _ in range(repeat):
+					start = time.process_time()
+
+					raw = 0
+					size = 0
+					obj = compressor.compressobj()
+
+					for chunk in _body(serializer, payload, batch_format):
+						raw += len(chunk)
+						size += len(obj.compress(chunk)) if obj else len(chunk)
+
+					if obj:
+						size += len(obj.flush())
+
+					elapsed = time.process_time() - start
+					best = elapsed if best is None else min(best, elapsed)
+
+				rows.append({
+					"format": batch_format,
+					"serializer": s_name,
+					"compression": c_name,
+					"level": level,
+					"raw_bytes": raw,
+					"bytes": size,
+					"bytes_per_event": size / count,
+					"us_per_event": best / count * 1e6,
+				})
+
+	return rows
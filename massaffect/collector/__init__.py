@@ -1,14 +1,34 @@
+import asyncio
+
 from abc import ABC, abstractmethod
 from typing import Iterator, Any
 
 from ..util import Loggable
 from ..state import MemoryStateStore
+from ..delta import DeltaEncoder
 
 class Collector(ABC, Loggable):
 	NAME = "base"
 	AUTOLOAD = False
 	# STATE = MemoryStateStore
 
+	# Collectors producing periodic snapshots set this, and pass their metrics through `encode`.
+	DELTA = False
+
+	# A `DeltaEncoder`, once `enable_delta` has been called.
+	delta = None
+
+	# Collectors that can tell when there's something new to collect set this, and create a
+	# `watch.Watcher` in `enable_watch`; they're then run in their own loop, woken by `wait`,
+	# rather than once per interval.
+	WATCH = False
+
+	watcher = None
+
+	# Set by a collector that stopped short of everything there was to collect (e.g. LogCollector,
+	# on its read budget); a watched collector is then run again right away.
+	backlog = False
+
 	def __init__(self, *args, **kwargs):
 		self.state = MemoryStateStore()
 
@@ -28,6 +48,33 @@ class Collector(ABC, Loggable):
 	async def start(self):
 		pass
 
+	async def stop(self):
+		pass
+
+	def enable_delta(self, keyframe_interval, tolerance=0.0):
+		self.delta = DeltaEncoder(keyframe_interval, tolerance)
+
+	def resync(self):
+		"""Called when the receiver has lost track of this collector's delta stream."""
+
+		if self.delta:
+			self.delta.resync()
+
+	def encode(self, metrics: dict[str, Any]) -> dict[str, Any]:
+		return self.delta.encode(metrics) if self.delta else metrics
+
+	def enable_watch(self, debounce: float) -> None:
+		pass
+
+	async def wait(self, timeout: float) -> None:
+		"""Returns once there may be something new to collect, or after `timeout` seconds."""
+
+		if self.watcher:
+			await self.watcher.wait(timeout)
+
+		else:
+			await asyncio.sleep(timeout)
+
 	def __repr__(self) -> str:
 		return f"{self.__class__.__name__}({self.name})"
 
@@ -0,0 +1,27 @@
+from . import Collector
+
+class AgentCollector(Collector):
+	"""
+	Reports the agent's own health; `sources` maps a name to any object providing a `stats()`
+	method (Dispatcher, Transport, etc), whose result is included verbatim (counters are
+	cumulative, so receivers should diff consecutive events).
+	"""
+
+	NAME = "agent"
+
+	def __init__(self, sources):
+		super().__init__()
+
+		self.sources = sources
+
+	def collect(self):
+		metrics = {}
+
+		for name, source in self.sources.items():
+			stats = source.stats()
+
+			if stats:
+				metrics[name] = stats
+
+		if metrics:
+			yield metrics
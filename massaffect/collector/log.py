@@ -1,5 +1,11 @@
+import collections
+import fnmatch
+import functools
+import hashlib
 import json
+import os
 import re
+import time
 
 from abc import ABC, abstractmethod
 from pathlib import Path
@@ -7,56 +13,390 @@ from datetime import datetime, timezone
 # from typing import Optional
 
 from . import Collector
+from ..util import Loggable
 from ..state import FileStateStore
+from ..watch import Watcher
+
+def _identity(st):
+	return f"{st.st_dev}:{st.st_ino}"
+
+class Budget:
+	"""
+	Limits on how much is read in one go: a number of `lines`, `bytes`, and milliseconds (`ms`,
+	from creation); 0 means no limit. A budget with a `parent` charges it too, and is exhausted
+	as soon as either is.
+	"""
+
+	__slots__ = ("lines", "bytes", "deadline", "parent", "used_lines", "used_bytes")
+
+	def __init__(self, lines=0, bytes=0, ms=0, parent=None):
+		self.lines = lines
+		self.bytes = bytes
+		self.deadline = time.monotonic() + ms / 1000 if ms else None
+		self.parent = parent
+
+		self.used_lines = 0
+		self.used_bytes = 0
+
+	def charge(self, size):
+		self.used_lines += 1
+		self.used_bytes += size
+
+		if self.parent:
+			self.parent.charge(size)
+
+	@property
+	def exhausted(self):
+		return bool(
+			(self.lines and self.used_lines >= self.lines) or
+			(self.bytes and self.used_bytes >= self.bytes) or
+			(self.deadline is not None and time.monotonic() >= self.deadline) or
+			(self.parent and self.parent.exhausted)
+		)
+
+class LogFileCursor(Loggable):
+	"""
+	Follows a single log file, remembering (in `store`) how far it has been read. `lines` reads
+	the new data in binary, `CHUNK_SIZE` chunks at a time, and yields it a line at a time, so
+	memory use is the same whatever the size of the backlog. A final line without its newline
+	(still being written) is held back until a later read; and the offset only moves past a
+	line once the consumer has asked for the next one (or finished), so a line is never split
+	or skipped.
+
+	Progress is saved per file, keyed by device and inode, along with a fingerprint (a hash of
+	its first `FINGERPRINT_SIZE` bytes) that tells a reused inode apart from the file that had
+	it; so a file is never skipped, nor read again, just because of where it is. The file last
+	read under this cursor's name is saved too: once that changes (the log was rotated), the
+	rest of the previous file is read first, from its rotated name (`path` + `ROTATED_SUFFIX`),
+	whether it was renamed there or copied (`copytruncate`). As its writer may keep appending
+	to it until it reopens the log, the rotated file is followed until it has gone
+	`ROTATED_GRACE` seconds without a write.
+
+	Given a `Budget`, `lines` stops once it's exhausted (having saved its progress, so the next
+	call carries on from there); `deferred` is then set. `lag` is how many bytes were left
+	unread.
+	"""
+
+	CHUNK_SIZE = 1024 * 1024
+
+	# A "line" growing past this without a newline is yielded as is, to keep memory bounded.
+	MAX_LINE = 1024 * 1024
+
+	FINGERPRINT_SIZE = 1024
+
+	ROTATED_SUFFIX = ".1"
+	ROTATED_GRACE = 60
+
+	# Names not seen for this long (in seconds) are forgotten by `prune`; when nothing else
+	# changes, when a name was seen is only updated every `SEEN_INTERVAL` seconds.
+	MAX_AGE = 7 * 86400
+	SEEN_INTERVAL = 3600
 
-class LogFileCursor:
 	def __init__(self, path: Path, store: FileStateStore):
 		self.path = path
 		self.store = store
 
-	def read_new(self):
-		if not self.path.exists():
-			return []
+		self.lag = 0
+		self.deferred = False
+
+	@property
+	def key(self):
+		return f"log.path:{self.path}"
+
+	@staticmethod
+	def file_key(identity):
+		return f"log.file:{identity}"
+
+	@classmethod
+	def prune(cls, store):
+		"""
+		Forgets names that haven't been seen for `MAX_AGE` seconds, and files that are no longer
+		where they were last read (rotated away, or deleted), unless still referred to by a name.
+		"""
+
+		now = time.time()
+		referenced = set()
+
+		for key in store.keys():
+			if key.startswith("log.path:"):
+				named = store.get(key)
+
+				if now - named["seen"] > cls.MAX_AGE:
+					store.delete(key)
+
+				else:
+					referenced.update((named["file"], named["rotated"]))
+
+		for key in store.keys():
+			if not key.startswith("log.file:"):
+				continue
+
+			identity = key.removeprefix("log.file:")
+
+			if identity in referenced:
+				continue
+
+			try:
+				moved = _identity(os.stat(store.get(key)["path"])) != identity
+
+			except OSError:
+				moved = True
+
+			if moved:
+				store.delete(key)
+
+	@staticmethod
+	def _fingerprint(fd, size):
+		data = os.pread(fd, size, 0)
+
+		return hashlib.md5(data).hexdigest(), len(data)
+
+	def _resume(self, path, st, entry):
+		"""
+		The offset to resume reading `path` (whose stat is `st`) at, according to the saved
+		`entry`; or None if that doesn't describe this file (which is shorter, or starts with
+		different data).
+		"""
+
+		if not entry or st.st_size < entry["offset"]:
+			return None
+
+		try:
+			with open(path, "rb") as f:
+				fingerprint, _ = self._fingerprint(f.fileno(), entry["fingerprint_size"])
+
+		except OSError:
+			return None
+
+		return entry["offset"] if fingerprint == entry["fingerprint"] else None
+
+	def _legacy(self, st):
+		"""The offset saved by earlier versions, which keyed it by path, with no fingerprint."""
 
-		st = self.path.stat()
-		inode = st.st_ino
-		size = st.st_size
-		# saved = self.store.get(self.path)
-		# key = f"{self.name}:{self.path.resolve()}"
 		key = f"log:{self.path.resolve()}"
 		saved = self.store.get(key)
-		offset = 0
 
-		if saved:
-			if saved["inode"] == inode:
-				offset = saved["offset"]
+		if saved is None:
+			return None
 
-				# File was probably truncated.
-				if size < offset:
-					offset = 0
+		self.store.delete(key)
 
-			# Likely rotated to .1, .2, etc.
-			else:
-				offset = 0
+		if saved["inode"] != st.st_ino or st.st_size < saved["offset"]:
+			return None
 
-		lines = []
+		return saved["offset"]
 
-		with self.path.open("r") as f:
-			f.seek(offset)
+	def _drain(self, entry, first, budget):
+		"""
+		Reads the rest of the file described by `entry` (the previous file under this name) from
+		its rotated name; returns the identity of the rotated file, if it's to be followed.
+		"""
+
+		rotated = Path(f"{self.path}{self.ROTATED_SUFFIX}")
+
+		try:
+			st = os.stat(rotated)
+			offset = self._resume(rotated, st, entry)
+
+		except OSError:
+			offset = None
+
+		if offset is None:
+			if first:
+				self.log.warning(
+					f"{self.path} was replaced, and the previous file isn't {rotated}; "
+					"any lines it had left are lost"
+				)
+
+			return None
+
+		if first:
+			self.log.info(f"{self.path} was rotated; reading the rest of {rotated}")
+
+		identity = _identity(st)
+
+		yield from self._read(rotated, identity, offset, budget)
+
+		# Still followed when the budget ran out before its end, however long ago it was written.
+		if not self.deferred and time.time() - st.st_mtime >= self.ROTATED_GRACE:
+			return None
 
-			for line in f:
-				lines.append(line.rstrip("\n"))
+		return identity
 
-			new_offset = f.tell()
+	def lines(self, budget=None):
+		try:
+			st = os.stat(self.path)
 
-		# self.store.update(self.path, inode, new_offset)
+		except FileNotFoundError:
+			return
 
-		self.store.set(key, {
-			"inode": inode,
-			"offset": new_offset,
+		identity = _identity(st)
+		named = self.store.get(self.key)
+		entry = self.store.get(self.file_key(identity))
+
+		# Nothing new; by far the most common case.
+		if (
+			named and named["file"] == identity and not named["rotated"] and
+			entry and entry["offset"] == st.st_size
+		):
+			now = time.time()
+
+			if now - named["seen"] >= self.SEEN_INTERVAL:
+				self.store.set(self.key, {**named, "seen": now})
+
+			return
+
+		offset = self._resume(self.path, st, entry)
+		rotated = None
+		replaced = False
+
+		if not named:
+			if offset is None:
+				offset = self._legacy(st)
+
+		# Another file has taken this name since the last read, or this one was truncated.
+		elif named["file"] != identity or offset is None:
+			previous = self.store.get(self.file_key(named["file"]))
+			replaced = True
+
+			if previous:
+				rotated = yield from self._drain(previous, True, budget)
+
+		elif named["rotated"]:
+			rotated = yield from self._drain(
+				self.store.get(self.file_key(named["rotated"])),
+				False,
+				budget
+			)
+
+		# Not done with the previous file; this one waits for the next call.
+		if self.deferred:
+			self.lag += st.st_size - (offset or 0)
+
+			# Just rotated: the next call carries on with the rotated file from where this one
+			# stopped, and then reads this one from the start.
+			if replaced and rotated:
+				self._start(identity)
+
+				self.store.set(self.key, {
+					"file": identity,
+					"rotated": rotated,
+					"seen": time.time(),
+				})
+
+			return
+
+		self.store.set(self.key, {
+			"file": identity,
+			"rotated": rotated,
+			"seen": time.time(),
+		})
+
+		yield from self._read(self.path, identity, offset or 0, budget)
+
+	def _save(self, fd, path, identity, offset):
+		fingerprint, size = self._fingerprint(fd, self.FINGERPRINT_SIZE)
+
+		self.store.set(self.file_key(identity), {
+			"path": str(path),
+			"offset": offset,
+			"fingerprint": fingerprint,
+			"fingerprint_size": size,
 		})
 
-		return lines
+	def _start(self, identity):
+		"""Saves the file under this name (`identity`) as to be read from the start."""
+
+		try:
+			f = open(self.path, "rb")
+
+		except FileNotFoundError:
+			return
+
+		with f:
+			if _identity(os.fstat(f.fileno())) == identity:
+				self._save(f.fileno(), self.path, identity, 0)
+
+	def _read(self, path, identity, offset, budget):
+		try:
+			f = open(path, "rb")
+
+		except FileNotFoundError:
+			return
+
+		with f:
+			st = os.fstat(f.fileno())
+
+			# Replaced since it was looked at; the next read will sort it out.
+			if _identity(st) != identity:
+				return
+
+			f.seek(offset)
+
+			try:
+				# Unconsumed bytes (a partial line) carried over from the previous chunk, and the
+				# file offset they start at.
+				pending = b""
+				position = offset
+
+				while chunk := f.read(self.CHUNK_SIZE):
+					data = pending + chunk if pending else chunk
+					start = 0
+
+					while (end := data.find(b"\n", start)) != -1:
+						line = data[start:end]
+						start = end + 1
+
+						yield line.rstrip(b"\r").decode(errors="replace")
+
+						offset = position + start
+
+						if budget:
+							budget.charge(len(line) + 1)
+
+							if budget.exhausted:
+								self.deferred = True
+
+								return
+
+					pending = data[start:]
+					position += start
+
+					if len(pending) > self.MAX_LINE:
+						self.log.warning(f"{path}: line exceeds {self.MAX_LINE} bytes")
+
+						yield pending.decode(errors="replace")
+
+						position += len(pending)
+						offset = position
+
+						if budget:
+							budget.charge(len(pending))
+
+							if budget.exhausted:
+								self.deferred = True
+
+								return
+
+						pending = b""
+
+			finally:
+				self.lag += os.fstat(f.fileno()).st_size - offset
+
+				self._save(f.fileno(), path, identity, offset)
+
+@functools.lru_cache(maxsize=4096)
+def _time_local(value):
+	"""
+	Converts a `$time_local` ("01/Mar/2026:04:14:48 +0000") to ISO 8601 in UTC, or None; cached,
+	as consecutive lines mostly share the same second.
+	"""
+
+	try:
+		return datetime.strptime(value, "%d/%b/%Y:%H:%M:%S %z").astimezone(timezone.utc).isoformat()
+
+	except Exception:
+		return None
 
 class Parser(ABC):
 	NAME = ""
@@ -150,14 +490,7 @@ class NginxParser:
 		tl = data.get("time_local")
 
 		if tl:
-			try:
-				data["time_local"] = datetime.strptime(
-					tl,
-					"%d/%b/%Y:%H:%M:%S %z"
-				).astimezone(timezone.utc).isoformat()
-
-			except Exception:
-				data["time_local"] = None
+			data["time_local"] = _time_local(tl)
 
 		# Split request line
 		if data["request"]:
@@ -168,13 +501,272 @@ class NginxParser:
 
 		return data
 
+def _int(value):
+	return int(value) if value.isdecimal() else None
+
+def _bytes(value):
+	# Apache's %b logs "-" for no bytes.
+	return int(value) if value.isdecimal() else 0
+
+def _seconds(value):
+	# Upstream timings hold one value per upstream tried ("0.002, 0.010 : 0.003"); their total.
+	try:
+		return sum(float(v) for v in value.replace(":", ",").split(","))
+
+	except ValueError:
+		return None
+
+def _microseconds(value):
+	value = _int(value)
+
+	return value / 1000000 if value is not None else None
+
+@functools.lru_cache(maxsize=4096)
+def _time_iso8601(value):
+	try:
+		return datetime.fromisoformat(value).astimezone(timezone.utc).isoformat()
+
+	except ValueError:
+		return None
+
+class LogFormatParser:
+	"""
+	Parses the lines of a particular `log_format` (set in the collector's entry, next to
+	`parser = "log_format"`): either nginx's, naming variables (e.g.
+	`$remote_addr - $remote_user [$time_local] "$request" $status $request_time`), or an
+	Apache/OpenLiteSpeed `LogFormat`, made of directives (e.g. `%v %h %l %u %t "%r" %>s %b`).
+
+	The format is compiled into a single regex capturing exactly its fields (each matching up
+	to the character following it in the format), and a list of conversions for just those
+	fields that have a type (see `TYPES`); `time_local` and `time_iso8601` are normalized to ISO
+	8601 in UTC, as by NginxParser, and `request` is split into `method`, `path` and `protocol`.
+	Apache directives are given the names of their nginx equivalents (`%h` is `remote_addr`,
+	`%{X-MA-Request-ID}i` is `http_x_ma_request_id`, etc; see `DIRECTIVES`), so the same
+	field has the same name whatever the server.
+	"""
+
+	NAME = "log_format"
+
+	TYPES = {
+		"status": _int,
+		"request_length": _int,
+		"connection": _int,
+		"connection_requests": _int,
+		"remote_port": _int,
+		"server_port": _int,
+		"body_bytes_sent": _bytes,
+		"bytes_sent": _bytes,
+		"request_time": _seconds,
+		"upstream_response_time": _seconds,
+		"upstream_connect_time": _seconds,
+		"upstream_header_time": _seconds,
+		"msec": _seconds,
+		"time_local": _time_local,
+		"time_iso8601": _time_iso8601,
+	}
+
+	# Apache/OLS directive -> nginx variable name (None for those not worth capturing), or
+	# (name, conversion) where the value's unit differs.
+	DIRECTIVES = {
+		"a": "remote_addr",
+		"h": "remote_addr",
+		"l": None,
+		"u": "remote_user",
+		"t": "time_local",
+		"r": "request",
+		"s": "status",
+		"b": "body_bytes_sent",
+		"B": "body_bytes_sent",
+		"O": "bytes_sent",
+		"I": "request_length",
+		"D": ("request_time", _microseconds),
+		"T": "request_time",
+		"v": "vhost",
+		"V": "server_name",
+		"m": "method",
+		"U": "path",
+		"q": "query_string",
+		"H": "protocol",
+		"p": "server_port",
+	}
+
+	# %{Name}<letter> -> the prefix of the variable named after `Name`.
+	HEADERS = {
+		"i": "http_",
+		"o": "sent_http_",
+		"C": "cookie_",
+	}
+
+	NGINX_VARIABLE = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+	APACHE_DIRECTIVE = re.compile(r"%(?:[<>]|!?\d+(?:,\d+)*)*(?:\{([^}]*)\})?([a-zA-Z%])")
+
+	def __init__(self, log_format):
+		self.log_format = log_format
+
+		tokens = self._tokenize(log_format)
+
+		self.regex, self.conversions = self._compile(tokens)
+		self.split_request = "request" in self.regex.groupindex
+
+	def _directive(self, m):
+		argument, letter = m.groups()
+
+		if letter == "%":
+			return "%"
+
+		if argument is None and letter in self.DIRECTIVES:
+			field = self.DIRECTIVES[letter]
+
+			if not isinstance(field, tuple):
+				field = (field, self.TYPES.get(field))
+
+			# %t includes the brackets; [$time_local] in nginx.
+			return ["[", field, "]"] if letter == "t" else [field]
+
+		if argument is not None and letter in self.HEADERS:
+			name = self.HEADERS[letter] + re.sub(r"\W", "_", argument.lower())
+
+			return [(name, None)]
+
+		# A %{format}t time, left as is.
+		if argument is not None and letter == "t":
+			return [("time", None)]
+
+		raise ValueError(f"Unsupported log format directive: {m.group()}")
+
+	def _tokenize(self, log_format):
+		"""Splits `log_format` into literal strings and (name, conversion) fields."""
+
+		nginx = self.NGINX_VARIABLE.search(log_format) is not None
+		pattern = self.NGINX_VARIABLE if nginx else self.APACHE_DIRECTIVE
+		tokens = []
+		position = 0
+
+		for m in pattern.finditer(log_format):
+			tokens.append(log_format[position:m.start()])
+
+			if nginx:
+				name = m.group(1) or m.group(2)
+
+				tokens.append((name, self.TYPES.get(name)))
+
+			else:
+				tokens.extend(self._directive(m))
+
+			position = m.end()
+
+		tokens.append(log_format[position:])
+
+		if not any(isinstance(t, tuple) for t in tokens):
+			raise ValueError(f"No fields in log format: {log_format!r}")
+
+		# Adjacent literals merged, empty ones dropped.
+		merged = []
+
+		for token in tokens:
+			if isinstance(token, str) and merged and isinstance(merged[-1], str):
+				merged[-1] += token
+
+			elif token != "":
+				merged.append(token)
+
+		return merged
+
+	@staticmethod
+	def _compile(tokens):
+		pattern = []
+		conversions = []
+		captured = set()
+
+		for i, token in enumerate(tokens):
+			if isinstance(token, str):
+				pattern.append(re.escape(token))
+
+				continue
+
+			name, convert = token
+			following = tokens[i + 1] if i + 1 < len(tokens) else None
+
+			# One value per upstream tried: "10.0.0.1:80, 10.0.0.2:80 : 10.0.0.3:80".
+			if name and name.startswith("upstream_"):
+				field = r"\S*(?:(?:,| :) \S*)*"
+
+			elif following is None:
+				field = ".*"
+
+			elif isinstance(following, str):
+				field = f"[^{re.escape(following[0])}]*"
+
+			# Two fields in a row; only whitespace can tell them apart.
+			else:
+				field = r"\S*"
+
+			# Only the first of fields with the same name (%a and %h, say) is captured.
+			if name is None or name in captured:
+				pattern.append(f"(?:{field})")
+
+			else:
+				pattern.append(f"(?P<{name}>{field})")
+				captured.add(name)
+
+				if convert:
+					conversions.append((name, convert))
+
+		return re.compile("".join(pattern)), conversions
+
+	def parse(self, line: str) -> dict | None:
+		m = self.regex.fullmatch(line)
+
+		if not m:
+			return None
+
+		data = m.groupdict()
+
+		for name, convert in self.conversions:
+			data[name] = convert(data[name])
+
+		if self.split_request and data["request"]:
+			parts = data["request"].split()
+
+			if len(parts) == 3:
+				data["method"], data["path"], data["protocol"] = parts
+
+		return data
+
 class LogCollector(Collector):
+	"""
+	Tails the files matching `patterns` (globs, e.g. "/home/*/logs/*_access.log").
+
+	The matching files are cached per directory, so a collection only touches files already
+	known. The patterns are expanded again every `rescan_interval` seconds; and, when watched
+	(see `watch.Watcher`), just the directories in which matching files were created, moved or
+	deleted are re-listed as soon as that happens. `rescan_interval` defaults to 300 seconds
+	when watched, and to every collection otherwise.
+
+	How much a collection reads can be limited, so a single large backlog doesn't hold up the
+	other files (or, as `collect` is synchronous, the agent): `budget` for the whole collection,
+	and `file_budget` for each file, both mapping "lines", "bytes" and/or "ms" to a limit (see
+	`Budget`). Files are taken in turn, the next collection starting with the file the last
+	one stopped at; and `backlog` is set, so a watched collector is run again right away.
+	`stats` reports how far (in bytes) each file is behind.
+	"""
+
 	NAME = "logs"
+	WATCH = True
+
+	PRUNE_INTERVAL = 3600
+
+	# Seconds between saves of the cursors (when they've changed at all); after a crash, up to
+	# this much may be read again.
+	SAVE_INTERVAL = 5
 
 	def __init__(self,
 		patterns=None,
 		parser=None,
-		state_file=None
+		state_file=None,
+		rescan_interval=None,
+		budget=None,
+		file_budget=None
 	):
 		self.patterns = patterns or [
 			# "/var/log/nginx/access*.log"
@@ -184,6 +776,44 @@ class LogCollector(Collector):
 		self.parser = parser or RawParser()
 		# self.state = LogStateStore(Path(state_file or ".ma_logstate.json"))
 		self.state = FileStateStore(Path(state_file or ".ma_logstate.json"))
+		self.rescan_interval = rescan_interval
+		self.budget = budget or {}
+		self.file_budget = file_budget or {}
+
+		# Rejecting unknown limits (as a TypeError, like any other bad option).
+		Budget(**self.budget)
+		Budget(**self.file_budget)
+
+		# Directory -> the files in it matching any pattern; from the last `_scan`.
+		self.files = {}
+
+		# Path -> bytes left unread by the last collection that read it.
+		self.lag = {}
+
+		self.counters = collections.Counter()
+
+		# (directory, file name) patterns; relative ones are anchored at "/", as with `Path.glob`.
+		self._patterns = [os.path.split("/" + p.lstrip("/")) for p in self.patterns]
+
+		# Directory -> the file name patterns of the patterns it was expanded from.
+		self._names = {}
+		self._scanned = None
+		self._pruned = None
+		self._resume = None
+		self._saved = None
+
+	def enable_watch(self, debounce):
+		self.watcher = Watcher(debounce)
+
+	async def start(self):
+		if self.watcher:
+			self.watcher.start()
+
+	async def stop(self):
+		if self.watcher:
+			self.watcher.close()
+
+		self.state.save()
 
 	@property
 	def name(self):
@@ -194,22 +824,138 @@ class LogCollector(Collector):
 
 		return n
 
+	def _scan_dir(self, directory):
+		names = self._names.get(directory, ())
+
+		try:
+			entries = os.scandir(directory)
+
+		except OSError:
+			self.files.pop(directory, None)
+
+			return
+
+		with entries:
+			self.files[directory] = sorted(
+				Path(e.path) for e in entries
+				if any(fnmatch.fnmatchcase(e.name, n) for n in names) and e.is_file()
+			)
+
+		if self.watcher:
+			self.watcher.watch(directory, names)
+
+	def _scan(self):
+		self.files = {}
+		self._names = {}
+
+		for directory, name in self._patterns:
+			if directory == "/":
+				matches = [Path("/")]
+
+			else:
+				matches = Path("/").glob(directory.lstrip("/"))
+
+			for path in matches:
+				if path.is_dir():
+					self._names.setdefault(str(path), []).append(name)
+
+		for directory in self._names:
+			self._scan_dir(directory)
+
+		self._scanned = time.monotonic()
+
+		# Saved cursors for files that are gone (see `LogFileCursor.prune`).
+		if self._pruned is None or self._scanned - self._pruned >= self.PRUNE_INTERVAL:
+			LogFileCursor.prune(self.state)
+
+			self._pruned = self._scanned
+
+	def paths(self):
+		"""The files to collect from; see the class documentation."""
+
+		watched = self.watcher and self.watcher.active
+		interval = self.rescan_interval
+
+		if interval is None:
+			interval = 300 if watched else 0
+
+		if (
+			self._scanned is None or
+			time.monotonic() - self._scanned >= interval or
+			(watched and self.watcher.overflowed)
+		):
+			if watched:
+				self.watcher.overflowed = False
+				self.watcher.take_changed()
+
+			self._scan()
+
+		elif watched:
+			for directory in self.watcher.take_changed():
+				self._scan_dir(directory)
+
+		return [path for files in self.files.values() for path in files]
+
 	def collect(self):
-		for pattern in self.patterns:
-			base = Path("/")
+		paths = self.paths()
+		budget = Budget(**self.budget)
 
-			for path in base.glob(pattern.lstrip("/")):
-				cursor = LogFileCursor(path, self.state)
+		# Starting where the last collection ran out of budget.
+		if self._resume in paths:
+			start = paths.index(self._resume)
+			paths = paths[start:] + paths[:start]
 
-				for line in cursor.read_new():
-					parsed = self.parser.parse(line)
+		self._resume = None
+		self.backlog = False
 
-					if not parsed:
-						continue
+		for path in paths:
+			if budget.exhausted:
+				self._resume = path
+				self.backlog = True
 
-					yield {
-						"source": str(path),
-						**parsed,
-					}
+				break
 
-		self.state.save()
+			cursor = LogFileCursor(path, self.state)
+
+			for line in cursor.lines(Budget(**self.file_budget, parent=budget)):
+				parsed = self.parser.parse(line)
+
+				if not parsed:
+					continue
+
+				yield {
+					"source": str(path),
+					**parsed,
+				}
+
+			self.lag[str(path)] = cursor.lag
+
+			if cursor.deferred:
+				self.backlog = True
+
+				if budget.exhausted:
+					self._resume = path
+
+					break
+
+		if self.backlog:
+			self.counters["deferred"] += 1
+
+		# Forgetting files no longer matched.
+		for path in self.lag.keys() - {str(p) for p in paths}:
+			del self.lag[path]
+
+		now = time.monotonic()
+
+		if self._saved is None or now - self._saved >= self.SAVE_INTERVAL:
+			self.state.save()
+
+			self._saved = now
+
+	def stats(self):
+		return {
+			"files": sum(len(files) for files in self.files.values()),
+			"lag_bytes": sum(self.lag.values()),
+			"lag": {path: lag for path, lag in self.lag.items() if lag},
+			**self.counters,
+		}
@@ -8,6 +8,7 @@ from . import Collector
 class ProcessCollector(Collector):
 	NAME = "process"
 	AUTOLOAD = True
+	DELTA = True
 
 	SAMPLE_INTERVAL = 2.5 # seconds
 	TOP_N = 5 # number of processes to report
@@ -102,7 +103,14 @@ class ProcessCollector(Collector):
 				**info,
 			})
 
-		if metrics:
+		if not metrics:
+			return
+
+		# Keyed by pid in delta mode, so an unchanged `cmdline` (etc) isn't resent every interval.
+		if self.delta:
+			yield self.encode({ "top": {str(m["pid"]): m for m in metrics} })
+
+		else:
 			yield { "top": metrics }
 
 	# --------------------------------------------------------------------------------------------
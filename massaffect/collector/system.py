@@ -7,6 +7,7 @@ from . import Collector
 class SystemCollector(Collector):
 	NAME = "system"
 	AUTOLOAD = True
+	DELTA = True
 
 	def collect(self):
 		load1, load5, load15 = os.getloadavg()
@@ -32,13 +33,13 @@ class SystemCollector(Collector):
 		self.state.set("cpu.prev", cpu_cur)
 		self.state.set("cpu.ts", time.time())
 
-		yield {
+		yield self.encode({
 			# "hostname": socket.gethostname(),
 			"load1": load1,
 			"load5": load5,
 			"load15": load15,
 			**(cpu or {}),
-		}
+		})
 
 	def _read_cpu(self):
 		with open("/proc/stat") as f:
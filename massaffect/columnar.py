@@ -0,0 +1,157 @@
+"""
+An optional, column-oriented batch format.
+
+The events of a batch are grouped by `collector`, and each envelope key (`ts`, `site`, ...) and
+each `metrics` key becomes a column holding that key's value for every event in the group.
+Columns of repetitive strings (source paths, user agents, methods, ...) are dictionary
+encoded; so a batch of `logs.nginx` lines names every key only once, and every distinct
+user agent only once.
+
+	{
+		"format": "columnar/1",
+		"groups": [
+			{
+				"collector": "logs.nginx",
+				"count": 3,
+				"fields": {
+					"ts": {"values": [1772338488, 1772338488, 1772338489]}
+				},
+				"metrics": {
+					"status": {"values": [200, 404, 200]},
+					"method": {"dict": ["GET", "POST"], "index": [0, 0, 1]},
+					"http_referer": {"values": ["-", null, "-"], "absent": [1]}
+				}
+			}
+		]
+	}
+
+`absent` lists the rows that didn't have the key at all (their slot holds null). If any event
+in a group has a non-object `metrics`, the group stores `metrics` as a regular field instead.
+`decode_batch` restores the original list of events; their order is preserved per collector
+(but not across collectors).
+"""
+
+FORMAT = "columnar/1"
+
+def _encode_column(rows, key):
+	values = []
+	absent = []
+
+	for i, row in enumerate(rows):
+		if key in row:
+			values.append(row[key])
+
+		else:
+			values.append(None)
+			absent.append(i)
+
+	column = {"values": values}
+	strings = [v for v in values if isinstance(v, str)]
+
+	# Dictionary encode string columns with enough repetition to pay for the dictionary.
+	if strings and len(strings) == len(values) - len(absent):
+		unique = {}
+
+		for v in strings:
+			unique.setdefault(v, len(unique))
+
+		if len(unique) <= len(strings) // 2:
+			column = {
+				"dict": list(unique),
+				"index": [unique.get(v, 0) for v in values],
+			}
+
+	if absent:
+		column["absent"] = absent
+
+	return column
+
+def _encode_columns(rows):
+	keys = {}
+
+	for row in rows:
+		for key in row:
+			keys.setdefault(key, None)
+
+	return {key: _encode_column(rows, key) for key in keys}
+
+def _decode_columns(columns, count):
+	rows = [{} for _ in range(count)]
+
+	for key, column in columns.items():
+		absent = set(column.get("absent", ()))
+
+		if "dict" in column:
+			values = [column["dict"][i] for i in column["index"]]
+
+		else:
+			values = column["values"]
+
+		for i, value in enumerate(values):
+			if i not in absent:
+				rows[i][key] = value
+
+	return rows
+
+def encode_batch(events):
+	"""
+	Converts a list of events into a single columnar document.
+	"""
+
+	groups = {}
+
+	for event in events:
+		groups.setdefault(event.get("collector"), []).append(event)
+
+	encoded = []
+
+	for collector, group in groups.items():
+		fields = [{k: v for k, v in e.items() if k != "collector"} for e in group]
+		metrics = None
+
+		if all(isinstance(f.get("metrics"), dict) for f in fields):
+			metrics = [f.pop("metrics") for f in fields]
+
+		entry = {
+			"collector": collector,
+			"count": len(group),
+			"fields": _encode_columns(fields),
+		}
+
+		if metrics is not None:
+			entry["metrics"] = _encode_columns(metrics)
+
+		encoded.append(entry)
+
+	return {
+		"format": FORMAT,
+		"groups": encoded,
+	}
+
+def decode_batch(doc):
+	"""
+	Converts a document produced by `encode_batch` back into the list of events.
+	"""
+
+	if doc.get("format") != FORMAT:
+		raise ValueError(f"Unsupported batch format: {doc.get('format')!r}")
+
+	events = []
+
+	for group in doc["groups"]:
+		count = group["count"]
+		fields = _decode_columns(group["fields"], count)
+
+		if "metrics" in group:
+			for f, m in zip(fields, _decode_columns(group["metrics"], count)):
+				f["metrics"] = m
+
+		for f in fields:
+			event = {"collector": group["collector"], **f}
+
+			if group["collector"] is None:
+				del event["collector"]
+
+			events.append(event)
+
+	return events
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+import socket
 
 try:
 	# In Python 3.11+, this is fine.
@@ -11,15 +12,19 @@ except ModuleNotFoundError:
 	import tomli as tomllib
 
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
 from typing import Any
 
 # Add additional collector/parser types here as needed.
-from .collector.log import LogCollector, NginxParser, RawParser
+from .collector.log import LogCollector, LogFormatParser, NginxParser, RawParser
+from .dispatch import QUEUE_POLICIES
+from .ratelimit import OVERFLOW_POLICIES
+from . import codec
 
 PARSERS = {
 	"raw": RawParser,
 	"nginx": NginxParser,
+	"log_format": LogFormatParser,
 }
 
 COLLECTORS = {
@@ -31,15 +36,147 @@ class SystemConfig:
 	redis: dict[str, Any] | None
 	postgres: dict[str, Any] | None
 
+@dataclass(slots=True)
+class QueueConfig:
+	# A value of 0 means "unbounded".
+	max_events: int = 100000
+	max_bytes: int = 64 * 1024 * 1024
+	# One of: block, drop_oldest, drop_newest, priority
+	policy: str = "block"
+	# Collector name -> priority; higher values are dropped last (default is 0).
+	priorities: dict[str, int] = field(default_factory=dict)
+
+@dataclass(slots=True)
+class FlushConfig:
+	# Flush as soon as any limit is reached (0 disables it); `interval` remains the upper bound.
+	batch_max_events: int = 1000
+	batch_max_bytes: int = 1024 * 1024
+	# Seconds the oldest queued event may wait before forcing a flush.
+	max_age: float = 0.0
+	# Batches sent concurrently; `ordered` keeps each collector's batches in send order.
+	max_in_flight: int = 4
+	ordered: bool = False
+
+@dataclass(slots=True)
+class SpoolConfig:
+	# Directory for undeliverable batches; an empty string disables spooling.
+	path: str = ".ma_spool"
+	max_bytes: int = 256 * 1024 * 1024
+	segment_bytes: int = 8 * 1024 * 1024
+	fsync_batches: int = 16
+	fsync_interval: float = 1.0
+	# Seconds allowed for the final flush at shutdown; the remainder is spooled.
+	shutdown_timeout: float = 5.0
+
+@dataclass(slots=True)
+class SocketConfig:
+	# Longest accepted line (one event, or a list of events) on the agent's socket; a producer
+	# exceeding it is disconnected.
+	max_line: int = 1024 * 1024
+	# Answer every line with a single byte: "+" (queued), "-" (invalid) or "!" (queue full).
+	ack: bool = False
+	# Name of the (abstract) SOCK_DGRAM socket; empty disables it.
+	dgram_name: str = ""
+	# Datagrams buffered before further ones are dropped, and the socket's SO_RCVBUF (0 keeps
+	# the system default).
+	dgram_max_pending: int = 8192
+	dgram_rcvbuf: int = 0
+
+@dataclass(slots=True)
+class ShmConfig:
+	# The shared-memory ring buffer (see `shmring.py`), e.g. "/dev/shm/massaffect.ring"; empty
+	# disables it.
+	path: str = ""
+	size: int = 16 * 1024 * 1024
+	mode: int = 0o660
+	# Seconds between polls of an empty ring, and the most frames handled per poll.
+	poll_interval: float = 0.01
+	max_frames: int = 1024
+
+@dataclass(slots=True)
+class LimitsConfig:
+	# Token-bucket limit on the events written to the agent's sockets, per collector: `rate`
+	# events per second (0 is unlimited), in bursts of up to `burst`.
+	rate: float = 0.0
+	burst: int = 0
+	# Separate buckets for every peer uid (SO_PEERCRED) writing to the stream socket.
+	per_peer: bool = False
+	overflow: str = "drop"
+	# Per collector (or fnmatch pattern) overrides of `rate`/`burst`.
+	collectors: dict[str, dict[str, float]] = field(default_factory=dict)
+
+@dataclass(slots=True)
+class RetryConfig:
+	# Retries per batch (after the first attempt); backoff is capped exponential + full jitter.
+	attempts: int = 4
+	backoff_base: float = 0.5
+	backoff_cap: float = 30.0
+	# Consecutive failures before the circuit opens, and seconds before it's probed again.
+	circuit_threshold: int = 5
+	circuit_reset: float = 30.0
+
+@dataclass(slots=True)
+class HTTPConfig:
+	pool_size: int = 8
+	# Seconds an idle connection is kept open.
+	keepalive: float = 30.0
+	connect_timeout: float = 3.0
+	read_timeout: float = 10.0
+	total_timeout: float = 30.0
+	dns_ttl: int = 300
+	# Seconds before a scheduled flush to (re)open a connection; 0 disables warm-up.
+	warm_ahead: float = 1.0
+
+@dataclass(slots=True)
+class DirectConfig:
+	# Length the per-collector Redis lists are trimmed to (as the controller does).
+	max_events: int = 2000
+
+@dataclass(slots=True)
+class WatchConfig:
+	# Run log collectors as soon as their files change (via inotify, where available), rather
+	# than once per interval; changes within `debounce` seconds are handled together.
+	enabled: bool = True
+	debounce: float = 0.25
+
+@dataclass(slots=True)
+class DeltaConfig:
+	# Send the system/process collectors as a keyframe every `keyframe_interval` snapshots, and
+	# only what changed (floats by more than `tolerance`) in between. The bundled controller
+	# doesn't decode these yet (it stores them as they are), so this stays off unless whatever
+	# receives the events applies them (see `delta.DeltaDecoder`).
+	enabled: bool = False
+	keyframe_interval: int = 20
+	tolerance: float = 0.0
+
 @dataclass(slots=True)
 class AgentConfig:
-	# hostname: str
+	# Used to pick this agent's primary controller, and by the "direct" transport as the name
+	# events are stored under (the controller maps IPs to names); defaults to the hostname.
+	name: str
 	interval: int
 	compression_threshold: int
+	serializer: str
+	compression: str
+	compression_level: int | None
+	batch_format: str
 	socket_name: str
-	controller_url: str
+	socket: SocketConfig
+	limits: LimitsConfig
+	shm: ShmConfig
+	controllers: list[str]
 	agent_secret: str
 	collectors: list[Any]
+	queue: QueueConfig
+	flush: FlushConfig
+	spool: SpoolConfig
+	retry: RetryConfig
+	lanes: dict[str, dict[str, int]]
+	delta: DeltaConfig
+	watch: WatchConfig
+	http: HTTPConfig
+	transport: str
+	direct: DirectConfig
 
 @dataclass(slots=True)
 class ReporterConfig:
@@ -80,6 +217,38 @@ def _expand_env(value: Any) -> Any:
 
 	return value
 
+def _load_section(cls, raw: dict[str, Any], name: str) -> Any:
+	"""
+	Builds the dataclass `cls` from the (optional) TOML table `name` found in `raw`; any
+	numeric fields given as strings (typically from ${VAR} expansion) are coerced using the
+	type of their default value.
+	"""
+
+	values = raw.get(name.split(".")[-1], {})
+
+	if not isinstance(values, dict):
+		raise ConfigError(f"[{name}] must be a table")
+
+	try:
+		section = cls(**values)
+
+	except TypeError as e:
+		raise ConfigError(f"Invalid [{name}] configuration: {e}")
+
+	for f in fields(section):
+		value = getattr(section, f.name)
+
+		if isinstance(f.default, bool) or not isinstance(f.default, (int, float)):
+			continue
+
+		try:
+			setattr(section, f.name, type(f.default)(value))
+
+		except (TypeError, ValueError):
+			raise ConfigError(f"[{name}] {f.name} must be a number")
+
+	return section
+
 def load_config(path: str | Path) -> Config:
 	path = Path(path)
 
@@ -109,13 +278,22 @@ def load_config(path: str | Path) -> Config:
 		agent = raw["agent"]
 
 		try:
-			# hostname = agent["hostname"]
-			controller_url = agent["controller_url"]
 			agent_secret = agent["agent_secret"]
 
 		except KeyError as e:
 			raise ConfigError(f"Missing required agent config field: {e.args[0]}")
 
+		# Either a single `controller_url`, or a list of `controllers` to shard across.
+		controllers = agent.get("controllers", agent.get("controller_url"))
+
+		if isinstance(controllers, str):
+			controllers = [controllers]
+
+		if not controllers or not all(isinstance(c, str) and c for c in controllers):
+			raise ConfigError("agent requires a controller_url, or a list of controllers")
+
+		agent_name = agent.get("name") or socket.gethostname()
+
 		try:
 			interval = int(agent.get("interval", 15))
 			compression_threshold = int(agent.get("compression_threshold", 512))
@@ -123,8 +301,64 @@ def load_config(path: str | Path) -> Config:
 		except ValueError:
 			raise ConfigError("interval and compression_threshold must be integers")
 
+		serializer = agent.get("serializer", "json")
+		compression = agent.get("compression", "gzip")
+		compression_level = agent.get("compression_level")
+
+		for name, registry in ((serializer, codec.SERIALIZERS), (compression, codec.COMPRESSORS)):
+			if name not in registry:
+				raise ConfigError(f"Unknown codec: {name}")
+
+			if not codec.available(registry[name]):
+				raise ConfigError(f"Codec '{name}' requires a module that isn't installed")
+
+		batch_format = agent.get("batch_format", "rows")
+
+		if batch_format not in ("rows", "columnar"):
+			raise ConfigError(f"Unknown batch_format: {batch_format}")
+
+		if compression_level is not None:
+			try:
+				compression_level = int(compression_level)
+
+			except ValueError:
+				raise ConfigError("compression_level must be an integer")
+
 		socket_name = "\0" + agent.get("socket_name", "massaffect")
 
+		socket_config = _load_section(SocketConfig, agent, "agent.socket")
+
+		if socket_config.dgram_name:
+			socket_config.dgram_name = "\0" + socket_config.dgram_name
+
+		limits = _load_section(LimitsConfig, agent, "agent.limits")
+
+		if limits.overflow not in OVERFLOW_POLICIES:
+			raise ConfigError(f"Unknown limits overflow policy: {limits.overflow}")
+
+		for name, options in limits.collectors.items():
+			if not isinstance(options, dict):
+				raise ConfigError(f"[agent.limits] entry '{name}' must be a table")
+
+			unknown = set(options) - {"rate", "burst"}
+
+			if unknown:
+				raise ConfigError(f"Unknown option(s) for limit '{name}': {', '.join(unknown)}")
+
+			try:
+				limits.collectors[name] = {k: float(v) for k, v in options.items()}
+
+			except ValueError:
+				raise ConfigError(f"Limit '{name}' options must be numbers")
+
+		transport = agent.get("transport", "debug_pretty")
+
+		if transport not in ("http", "direct", "debug", "debug_pretty"):
+			raise ConfigError(f"Unknown transport: {transport}")
+
+		if transport == "direct" and not (system and system.redis and system.postgres):
+			raise ConfigError("transport \"direct\" requires [system] redis and postgres settings")
+
 		collectors = []
 
 		for entry in agent.get("collectors", []):
@@ -147,7 +381,17 @@ def load_config(path: str | Path) -> Config:
 				if parser_name not in PARSERS:
 					raise ConfigError(f"Unknown parser: {parser_name}")
 
-				config["parser"] = PARSERS[parser_name]()
+				# Options for the parser, rather than the collector.
+				options = {}
+
+				if "log_format" in config:
+					options["log_format"] = config.pop("log_format")
+
+				try:
+					config["parser"] = PARSERS[parser_name](**options)
+
+				except (TypeError, ValueError) as e:
+					raise ConfigError(f"Invalid configuration for parser '{parser_name}': {e}")
 
 			try:
 				collectors.append(cls(**config))
@@ -157,14 +401,56 @@ def load_config(path: str | Path) -> Config:
 					f"Invalid configuration for collector '{type_name}': {e}"
 				)
 
+		queue = _load_section(QueueConfig, agent, "agent.queue")
+
+		if queue.policy not in QUEUE_POLICIES:
+			raise ConfigError(f"Unknown queue policy: {queue.policy}")
+
+		lanes = {}
+
+		for name, options in agent.get("lanes", {}).items():
+			if not isinstance(options, dict):
+				raise ConfigError(f"[agent.lanes] entry '{name}' must be a table")
+
+			unknown = set(options) - {"weight", "max_events", "max_bytes"}
+
+			if unknown:
+				raise ConfigError(f"Unknown option(s) for lane '{name}': {', '.join(unknown)}")
+
+			try:
+				lanes[name] = {k: int(v) for k, v in options.items()}
+
+			except ValueError:
+				raise ConfigError(f"Lane '{name}' options must be integers")
+
+			if lanes[name].get("weight", 1) < 1:
+				raise ConfigError(f"Lane '{name}' weight must be at least 1")
+
 		agent = AgentConfig(
-			# hostname=hostname,
+			name=agent_name,
 			interval=interval,
 			compression_threshold=compression_threshold,
+			serializer=serializer,
+			compression=compression,
+			compression_level=compression_level,
+			batch_format=batch_format,
 			socket_name=socket_name,
-			controller_url=controller_url,
+			socket=socket_config,
+			limits=limits,
+			shm=_load_section(ShmConfig, agent, "agent.shm"),
+			controllers=controllers,
 			agent_secret=agent_secret,
-			collectors=collectors
+			collectors=collectors,
+			queue=queue,
+			flush=_load_section(FlushConfig, agent, "agent.flush"),
+			spool=_load_section(SpoolConfig, agent, "agent.spool"),
+			retry=_load_section(RetryConfig, agent, "agent.retry"),
+			lanes=lanes,
+			delta=_load_section(DeltaConfig, agent, "agent.delta"),
+			watch=_load_section(WatchConfig, agent, "agent.watch"),
+			http=_load_section(HTTPConfig, agent, "agent.http"),
+			transport=transport,
+			direct=_load_section(DirectConfig, agent, "agent.direct")
 		)
 
 	# Reporter Section
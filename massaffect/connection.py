@@ -0,0 +1,176 @@
+import aiohttp
+import asyncio
+import collections
+import ssl
+import time
+
+from dataclasses import dataclass, asdict
+
+from .util import Loggable
+
+@dataclass(slots=True)
+class Timing:
+	"""
+	Where the time of a single request went, in milliseconds. `connect` covers both the TCP
+	handshake and TLS (aiohttp doesn't report them separately), and is 0 for a reused
+	keepalive connection; `ttfb` is from the start of the request to the response headers.
+	"""
+
+	dns: float = 0.0
+	connect: float = 0.0
+	ttfb: float = 0.0
+	total: float = 0.0
+	reused: bool = False
+
+	# Monotonic timestamps of the phases in progress (not reported).
+	_start: float = 0.0
+	_dns_start: float = 0.0
+	_connect_start: float = 0.0
+
+class ConnectionManager(Loggable):
+	"""
+	Owns the `aiohttp.ClientSession` used to reach the controller: a bounded pool of keepalive
+	connections, a DNS cache, separate connect/read timeouts and a single, shared `SSLContext`
+	(so certificates are loaded once, rather than per connection). Every request made with
+	`timing()` as its `trace_request_ctx` is timed, and summarized by `stats`.
+	"""
+
+	def __init__(self,
+		pool_size=8,
+		keepalive=30.0,
+		connect_timeout=3.0,
+		read_timeout=10.0,
+		total_timeout=30.0,
+		dns_ttl=300
+	):
+		self.keepalive = keepalive
+		self.ssl = ssl.create_default_context()
+
+		self.connector = aiohttp.TCPConnector(
+			limit=pool_size,
+			keepalive_timeout=keepalive,
+			use_dns_cache=True,
+			ttl_dns_cache=dns_ttl,
+			ssl=self.ssl
+		)
+
+		trace = aiohttp.TraceConfig()
+
+		trace.on_request_start.append(self._on_request_start)
+		trace.on_dns_resolvehost_start.append(self._on_dns_start)
+		trace.on_dns_resolvehost_end.append(self._on_dns_end)
+		trace.on_connection_create_start.append(self._on_connect_start)
+		trace.on_connection_create_end.append(self._on_connect_end)
+		trace.on_connection_reuseconn.append(self._on_reuse)
+		trace.on_request_end.append(self._on_request_end)
+
+		self.session = aiohttp.ClientSession(
+			connector=self.connector,
+			timeout=aiohttp.ClientTimeout(
+				total=total_timeout,
+				connect=connect_timeout,
+				sock_read=read_timeout
+			),
+			trace_configs=[trace]
+		)
+
+		self.last = None
+		self.counters = collections.Counter()
+		self.totals = collections.Counter()
+
+		self._last_used = 0.0
+
+	# --------------------------------------------------------------------------------------------
+	# aiohttp tracing hooks; `ctx.trace_request_ctx` is the `Timing` passed to the request.
+
+	@staticmethod
+	def _timing(ctx):
+		return ctx.trace_request_ctx if isinstance(ctx.trace_request_ctx, Timing) else None
+
+	async def _on_request_start(self, session, ctx, params):
+		if t := self._timing(ctx):
+			t._start = time.monotonic()
+
+	async def _on_dns_start(self, session, ctx, params):
+		if t := self._timing(ctx):
+			t._dns_start = time.monotonic()
+
+	async def _on_dns_end(self, session, ctx, params):
+		if t := self._timing(ctx):
+			t.dns = (time.monotonic() - t._dns_start) * 1000
+
+	async def _on_connect_start(self, session, ctx, params):
+		if t := self._timing(ctx):
+			t._connect_start = time.monotonic()
+
+	async def _on_connect_end(self, session, ctx, params):
+		if t := self._timing(ctx):
+			t.connect = (time.monotonic() - t._connect_start) * 1000
+
+	async def _on_reuse(self, session, ctx, params):
+		if t := self._timing(ctx):
+			t.reused = True
+
+	async def _on_request_end(self, session, ctx, params):
+		if t := self._timing(ctx):
+			t.ttfb = (time.monotonic() - t._start) * 1000
+
+	# --------------------------------------------------------------------------------------------
+
+	def timing(self):
+		return Timing()
+
+	def record(self, timing):
+		"""Called once the response of a timed request has been read."""
+
+		timing.total = (time.monotonic() - timing._start) * 1000
+
+		self.last = timing
+		self._last_used = time.monotonic()
+
+		self.counters["requests"] += 1
+		self.counters["reused" if timing.reused else "connected"] += 1
+
+		for phase in ("dns", "connect", "ttfb", "total"):
+			self.totals[phase] += getattr(timing, phase)
+
+	async def warm(self, url):
+		"""
+		Makes sure a connection to `url` is open (and its DNS cached), if the pool has been
+		idle long enough for keepalive connections to have been dropped.
+		"""
+
+		if time.monotonic() - self._last_used < self.keepalive / 2:
+			return
+
+		timing = self.timing()
+
+		try:
+			async with self.session.head(url, trace_request_ctx=timing) as resp:
+				await resp.read()
+
+			self.record(timing)
+
+			self.counters["warmed"] += 1
+
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			self.log.debug(f"Warm-up failed: {e}")
+
+	def stats(self):
+		stats = dict(self.counters)
+		requests = self.counters["requests"]
+
+		if requests:
+			for phase, total in self.totals.items():
+				stats[f"avg_{phase}_ms"] = round(total / requests, 2)
+
+		if self.last:
+			stats["last"] = {
+				k: round(v, 2) if isinstance(v, float) else v
+				for k, v in asdict(self.last).items() if not k.startswith("_")
+			}
+
+		return stats
+
+	async def close(self):
+		await self.session.close()
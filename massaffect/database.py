@@ -1,5 +1,7 @@
 import psycopg
 import redis
+import redis.asyncio
+import json
 import time
 import re
 import textwrap
@@ -39,6 +41,14 @@ def pg_execute(q, *args):
 # def redis_connect():
 # 	return redis.Redis(decode_responses=True)
 
+def redis_connect_async():
+	return redis.asyncio.Redis(**(config().system.redis or {}))
+
+def redis_events_key(agent, collector):
+	"""The Redis list holding the newest events of `collector` (see the controller)."""
+
+	return f"ma:agent:{agent}:{collector}:events"
+
 def sql_compact(sql: str) -> str:
 	"""
 	Attempts to remove all extraneous whitespace from an SQL query string;
@@ -187,6 +197,9 @@ class RedisDatabase:
 	def agents(self):
 		return self.r.smembers("ma:agent:index")
 
+	def events(self, agent, collector, limit=200):
+		return [json.loads(e) for e in self.r.lrange(redis_events_key(agent, collector), 0, limit - 1)]
+
 	def collectors(self, agent):
 		return self.r.smembers(f"ma:agent:{agent}:collectors:index")
 
@@ -205,6 +218,8 @@ __all__ = (
     "pg_connection",
     "pg_cursor",
     "pg_execute",
+    "redis_connect_async",
+    "redis_events_key",
     "sql_compact",
     "to_epoch",
     "ago",
@@ -0,0 +1,144 @@
+"""
+Delta encoding for periodic metric snapshots.
+
+Instead of a full snapshot every interval, a `DeltaEncoder` emits a keyframe every
+`keyframe_interval` snapshots, and only what changed in between:
+
+	{"seq": 0, "keyframe": {"load1": 0.12, "load5": 0.1, ...}}
+	{"seq": 1, "delta": {"load1": 0.31}}
+	{"seq": 2, "delta": {"top": {"1234": {"cpu_time": 57}}}, "removed": [["top", "987"]]}
+	{"seq": 3}
+
+Nested dicts are diffed recursively; any other value (lists included) is replaced whole.
+`removed` holds the key paths that no longer exist. Because `seq` increases by one for every
+snapshot, a receiver (see `DeltaDecoder`) can detect a gap and request a resync (a new
+keyframe) by returning `{"resync": ["<collector>", ...]}` in its response to a batch.
+
+The bundled controller doesn't do either yet; it stores delta events as they are, which is why
+delta mode is off by default.
+"""
+
+import copy
+
+def _changed(old, new, tolerance):
+	if isinstance(old, float) and isinstance(new, (int, float)):
+		return abs(new - old) > tolerance
+
+	return old != new or type(old) is not type(new)
+
+def diff(old, new, tolerance=0.0, path=()):
+	"""
+	Returns (delta, removed) between the dicts `old` and `new`.
+	"""
+
+	delta = {}
+	removed = []
+
+	for key, value in new.items():
+		if key not in old:
+			delta[key] = value
+
+		elif isinstance(value, dict) and isinstance(old[key], dict):
+			d, r = diff(old[key], value, tolerance, path + (key,))
+
+			if d:
+				delta[key] = d
+
+			removed.extend(r)
+
+		elif _changed(old[key], value, tolerance):
+			delta[key] = value
+
+	for key in old:
+		if key not in new:
+			removed.append(list(path + (key,)))
+
+	return delta, removed
+
+def patch(state, delta, removed=()):
+	"""
+	Applies the output of `diff` to `state` (in place), returning it.
+	"""
+
+	for key, value in delta.items():
+		if isinstance(value, dict) and isinstance(state.get(key), dict):
+			patch(state[key], value)
+
+		else:
+			state[key] = value
+
+	for path in removed:
+		node = state
+
+		for key in path[:-1]:
+			node = node.get(key, {})
+
+		node.pop(path[-1], None)
+
+	return state
+
+class DeltaEncoder:
+	def __init__(self, keyframe_interval=20, tolerance=0.0):
+		self.keyframe_interval = keyframe_interval
+		self.tolerance = tolerance
+		self.seq = 0
+
+		# The snapshot as the receiver will have reconstructed it; floats that changed by less
+		# than `tolerance` keep their old value here, so small drifts can't accumulate.
+		self._state = None
+
+	def resync(self):
+		"""Forces the next snapshot to be sent as a keyframe."""
+
+		self._state = None
+
+	def encode(self, snapshot):
+		seq = self.seq
+
+		self.seq += 1
+
+		if self._state is None or seq % self.keyframe_interval == 0:
+			self._state = copy.deepcopy(snapshot)
+
+			return {"seq": seq, "keyframe": snapshot}
+
+		delta, removed = diff(self._state, snapshot, self.tolerance)
+
+		# The delta goes out in an event, so the state mustn't share any (mutable) values with it.
+		patch(self._state, copy.deepcopy(delta), removed)
+
+		metrics = {"seq": seq}
+
+		if delta:
+			metrics["delta"] = delta
+
+		if removed:
+			metrics["removed"] = removed
+
+		return metrics
+
+class DeltaDecoder:
+	"""
+	Reconstructs the snapshots of a single (agent, collector) stream; `apply` returns None
+	until a keyframe arrives after a gap, in which case the sender should be asked to resync.
+	"""
+
+	def __init__(self):
+		self.seq = None
+		self.state = None
+
+	def apply(self, metrics):
+		seq = metrics["seq"]
+
+		if "keyframe" in metrics:
+			self.state = copy.deepcopy(metrics["keyframe"])
+
+		elif self.state is None or seq != self.seq + 1:
+			self.state = None
+
+		else:
+			patch(self.state, copy.deepcopy(metrics.get("delta", {})), metrics.get("removed", ()))
+
+		self.seq = seq
+
+		return self.state
@@ -1,70 +1,602 @@
 import asyncio
+import collections
+import fnmatch
+import json
+import time
 
+from .codec import RawEvent
 from .util import Loggable
 
+# What `enqueue` does once the queue (or the event's lane) has reached its limits:
+#
+#   block       - wait (applying backpressure to the producer) until a flush makes room
+#   drop_oldest - evict the oldest queued events
+#   drop_newest - discard the incoming event
+#   priority    - evict the oldest event from the lane with the lowest priority (or discard the
+#                 incoming event, if its own lane's priority is lower still)
+#
+# When only the event's own lane is full, the "drop_oldest" and "priority" policies both evict
+# the oldest event from that lane.
+QUEUE_POLICIES = ("block", "drop_oldest", "drop_newest", "priority")
+
+def event_size(payload):
+	"""
+	Returns the compact JSON size of `payload`; since `json.dumps` escapes non-ASCII by
+	default, the string length is also the byte length. A `RawEvent` is the size of its bytes.
+	"""
+
+	if isinstance(payload, RawEvent):
+		return len(payload.data)
+
+	return len(json.dumps(payload, separators=(",", ":")))
+
+class Lane:
+	"""
+	The queued events of a single collector. When a batch is built, lanes are visited in
+	rounds (highest `weight` first), each contributing up to `weight` events per round; so a
+	noisy lane can't crowd out the others. `max_events`/`max_bytes` cap the lane itself (0 is
+	unbounded) and `priority` is used by the "priority" queue policy.
+	"""
+
+	def __init__(self, name, weight=1, priority=0, max_events=0, max_bytes=0):
+		self.name = name
+		self.weight = weight
+		self.priority = priority
+		self.max_events = max_events
+		self.max_bytes = max_bytes
+
+		# Each entry is a (payload, size, monotonic enqueue time) tuple.
+		self.events = collections.deque()
+		self.bytes = 0
+
+	def __len__(self):
+		return len(self.events)
+
+	@property
+	def oldest(self):
+		return self.events[0][2]
+
+	def full(self, size):
+		if self.max_events and len(self.events) >= self.max_events:
+			return True
+
+		if self.max_bytes and self.events and self.bytes + size > self.max_bytes:
+			return True
+
+		return False
+
+	def push(self, payload, size):
+		self.events.append((payload, size, time.monotonic()))
+
+		self.bytes += size
+
+	def pop(self):
+		payload, size, _ = self.events.popleft()
+
+		self.bytes -= size
+
+		return payload, size
+
 class Dispatcher(Loggable):
-	def __init__(self, transport, interval):
+	def __init__(self,
+		transport,
+		interval,
+		max_events=0,
+		max_bytes=0,
+		policy="block",
+		priorities=None,
+		batch_max_events=0,
+		batch_max_bytes=0,
+		max_age=0,
+		spool=None,
+		max_in_flight=1,
+		ordered=False,
+		lanes=None,
+		warm_ahead=0
+	):
+		if policy not in QUEUE_POLICIES:
+			raise ValueError(f"Unknown queue policy: {policy}")
+
 		self.transport = transport
 		self.interval = interval
-		self.queue = asyncio.Queue()
+		self.max_events = max_events
+		self.max_bytes = max_bytes
+		self.policy = policy
+		self.priorities = priorities or {}
+
+		# Collector name (or fnmatch pattern) -> `Lane` keyword arguments (weight, max_events,
+		# max_bytes); collectors without a match get a lane of weight 1.
+		self.lane_config = lanes or {}
+
+		# Flush triggers (in addition to `interval`); each also caps the size of a single batch,
+		# except `max_age` (the number of seconds the oldest queued event may wait).
+		self.batch_max_events = batch_max_events
+		self.batch_max_bytes = batch_max_bytes
+		self.max_age = max_age
+
+		# An optional `spool.Spool`; batches that fail to send are written here (rather than
+		# being lost) and replayed, in order, by the `replay` task. New batches are still sent
+		# directly while it replays, so events may arrive out of order across a spill. Batches
+		# the transport rejects outright (its error isn't `retryable`) are dropped, spooled or
+		# not, and counted in `stats`; retrying them would only hold up everything after them.
+		self.spool = spool
+
+		# Up to `max_in_flight` batches are sent concurrently; if `ordered`, a batch waits for any
+		# earlier in-flight batch carrying events from the same collector(s).
+		self.max_in_flight = max_in_flight
+		self.ordered = ordered
+
+		# Seconds before a scheduled (timer) flush to call `transport.warm`; 0 disables it.
+		self.warm_ahead = warm_ahead
+
+		# Collector name -> Lane; `queued` and `queued_bytes` are the totals across all lanes.
+		self.lanes = {}
+		self.queued = 0
+		self.queued_bytes = 0
+
+		# Collector name -> number of events shed by the queue policy.
+		self.dropped = collections.Counter()
+
+		self.counters = collections.Counter()
 
 		self._running = True
+		self._not_full = asyncio.Condition()
+		self._wakeup = asyncio.Event()
+		self._spilled = asyncio.Event()
+		self._in_flight = asyncio.Semaphore(max_in_flight)
+		self._sending = set()
+		self._tails = {}
+		self._order = []
+		self._last_flush = time.monotonic()
+		self._dropped_reported = 0
+		self._warming = None
+
+	def _lane(self, name):
+		lane = self.lanes.get(name)
+
+		if lane:
+			return lane
+
+		options = self.lane_config.get(name)
+
+		if options is None:
+			options = next(
+				(o for pattern, o in self.lane_config.items() if fnmatch.fnmatchcase(name, pattern)),
+				{}
+			)
+
+		lane = Lane(name, priority=self.priorities.get(name, 0), **options)
+
+		self.lanes[name] = lane
+
+		# Heaviest lanes are visited first when building a batch.
+		self._order.append(lane)
+		self._order.sort(key=lambda l: -l.weight)
+
+		return lane
+
+	def _full(self, lane, size):
+		if lane.full(size):
+			return True
+
+		if self.max_events and self.queued >= self.max_events:
+			return True
+
+		# A single oversized event is still accepted into an otherwise empty queue.
+		if self.max_bytes and self.queued and self.queued_bytes + size > self.max_bytes:
+			return True
+
+		return False
+
+	def _drop(self, payload):
+		self.dropped[payload.get("collector", "unknown")] += 1
+
+	def _evict(self, lane, size):
+		"""
+		Removes one queued event to make room for an event of `size` bytes in `lane`, according
+		to the queue policy. Returns False if the incoming event should be dropped instead.
+		"""
+
+		if lane.full(size):
+			victim = lane
+
+		else:
+			candidates = [l for l in self.lanes.values() if l.events]
+
+			if self.policy == "priority":
+				priority = min(l.priority for l in candidates)
+
+				if lane.priority < priority:
+					return False
+
+				candidates = [l for l in candidates if l.priority == priority]
+
+			victim = min(candidates, key=lambda l: l.oldest)
+
+		payload, n = victim.pop()
+
+		self.queued -= 1
+		self.queued_bytes -= n
+
+		self._drop(payload)
+
+		return True
+
+	def _admit(self, lane, size, payload):
+		"""
+		Applies the queue policy (short of blocking) to fit an event of `size` bytes into `lane`.
+		Returns True if it can be pushed, False if it was dropped, or None if the producer has to
+		wait for a flush to make room ("block").
+		"""
+
+		if not self._full(lane, size):
+			return True
+
+		if self.policy == "block":
+			return None
+
+		if self.policy == "drop_newest":
+			self._drop(payload)
+
+			return False
+
+		while self._full(lane, size):
+			if not self._evict(lane, size):
+				self._drop(payload)
+
+				return False
+
+		return True
+
+	async def _wait_room(self, lane, size):
+		async with self._not_full:
+			await self._not_full.wait_for(lambda: not self._full(lane, size))
+
+	def _push(self, lane, payload, size):
+		lane.push(payload, size)
+
+		self.queued += 1
+		self.queued_bytes += size
+
+		# Wake `run` when a batch fills up, or when the first event starts the `max_age` clock.
+		if self._batch_ready() or (self.max_age and self.queued == 1):
+			self._wakeup.set()
 
 	async def enqueue(self, payload, flush=False):
 		"""
-		Add payload to queue.
+		Add payload to its collector's lane, applying the queue policy if it is full. Returns
+		False if the payload was dropped instead.
 
 		If flush=True, immediately flush after enqueue.
 		"""
 
-		await self.queue.put(payload)
+		lane = self._lane(payload.get("collector", "unknown"))
+		size = event_size(payload)
+		admitted = self._admit(lane, size, payload)
+
+		if admitted is None:
+			await self._wait_room(lane, size)
+
+		elif not admitted:
+			return False
+
+		self._push(lane, payload, size)
 
 		if flush:
 			await self.flush()
 
+		return True
+
+	async def enqueue_many(self, payloads):
+		"""
+		Like `enqueue`, for a list of payloads (in order); only suspends if the "block" policy
+		has to wait for room. Returns the number of payloads queued (the rest were dropped).
+		"""
+
+		queued = 0
+
+		for payload in payloads:
+			lane = self._lane(payload.get("collector", "unknown"))
+			size = event_size(payload)
+			admitted = self._admit(lane, size, payload)
+
+			if admitted is None:
+				await self._wait_room(lane, size)
+
+			elif not admitted:
+				continue
+
+			self._push(lane, payload, size)
+
+			queued += 1
+
+		return queued
+
+	def stats(self):
+		return {
+			"queued": self.queued,
+			"queued_bytes": self.queued_bytes,
+			"lanes": {name: len(lane) for name, lane in self.lanes.items() if lane.events},
+			"dropped": dict(self.dropped),
+			**self.counters,
+		}
+
+	def _batch_ready(self):
+		if self.batch_max_events and self.queued >= self.batch_max_events:
+			return True
+
+		if self.batch_max_bytes and self.queued_bytes >= self.batch_max_bytes:
+			return True
+
+		return False
+
+	def _deadline(self):
+		deadline = self._last_flush + self.interval
+
+		if self.max_age and self.queued:
+			oldest = min(l.oldest for l in self.lanes.values() if l.events)
+			deadline = min(deadline, oldest + self.max_age)
+
+		return deadline
+
+	def _take_batch(self):
+		"""
+		Removes (and returns) up to a batch worth of events, visiting the lanes in weighted
+		rounds; each collector's events keep their relative order.
+		"""
+
+		events = []
+		size = 0
+
+		while True:
+			added = False
+
+			for lane in self._order:
+				for _ in range(lane.weight):
+					if not lane.events:
+						break
+
+					n = lane.events[0][1]
+
+					if events:
+						if self.batch_max_events and len(events) >= self.batch_max_events:
+							break
+
+						if self.batch_max_bytes and size + n > self.batch_max_bytes:
+							break
+
+					payload, n = lane.pop()
+
+					self.queued -= 1
+					self.queued_bytes -= n
+
+					events.append(payload)
+
+					size += n
+					added = True
+
+			if not added:
+				return events
+
 	async def run(self):
 		"""
-		Periodically flush queued payloads.
+		Flush queued payloads whenever a batch fills up (by count or bytes), the oldest event
+		reaches `max_age`, or `interval` seconds have passed; whichever comes first.
 		"""
 
 		self.log.info(f"Running with {self.interval}s interval")
 
 		while self._running:
-			await asyncio.sleep(self.interval)
+			now = time.monotonic()
+			deadline = self._deadline()
+
+			if now < deadline and not self._batch_ready():
+				wake_at = deadline
+
+				if self.warm_ahead and self.queued and self._warming is None:
+					if deadline - now <= self.warm_ahead:
+						self._warming = asyncio.create_task(self.transport.warm())
+
+					else:
+						wake_at = deadline - self.warm_ahead
+
+				self._wakeup.clear()
+
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), wake_at - now)
+
+				except asyncio.TimeoutError:
+					pass
+
+				continue
+
+			self._last_flush = now
+			self._warming = None
+
 			await self.flush()
 
 		self.log.info("Stopped")
 
 	async def flush(self):
 		"""
-		Drain queue and send as batch.
+		Drain queue into one or more batches, each sent by its own task. This waits for a free
+		`max_in_flight` slot before taking each batch, but not for the sends to complete.
 		"""
 
-		events = []
+		while True:
+			await self._in_flight.acquire()
 
-		while not self.queue.empty():
-			try:
-				events.append(self.queue.get_nowait())
+			events = self._take_batch()
 
-			except asyncio.QueueEmpty:
-				break
+			if events:
+				self._start_send(events)
 
-		if not events:
-			return
+			else:
+				self._in_flight.release()
+
+			async with self._not_full:
+				self._not_full.notify_all()
+
+			self._report_dropped()
+
+			if not events:
+				return
+
+	def _start_send(self, events):
+		collectors = set()
+		predecessors = set()
+
+		if self.ordered:
+			collectors = {e.get("collector") for e in events}
+			predecessors = {self._tails[c] for c in collectors if c in self._tails}
+
+		task = asyncio.create_task(self._send_batch(events, collectors, predecessors))
 
+		for c in collectors:
+			self._tails[c] = task
+
+		self._sending.add(task)
+
+		task.add_done_callback(self._sending.discard)
+
+	async def _send_batch(self, events, collectors, predecessors):
+		try:
+			if predecessors:
+				await asyncio.wait(predecessors)
+
+			await self._send(events)
+
+		except asyncio.CancelledError:
+			# Cancelled mid-send (typically by shutdown); keep the batch if we can.
+			if self.spool:
+				self.spool.append(events)
+
+			raise
+
+		finally:
+			self._in_flight.release()
+
+			for c in collectors:
+				if self._tails.get(c) is asyncio.current_task():
+					del self._tails[c]
+
+	def _rejected(self, events, error):
+		"""
+		Whether `error` (from `transport.send`) means the batch will never be accepted; if so, it's
+		dropped (and counted).
+		"""
+
+		if getattr(error, "retryable", True):
+			return False
+
+		self.counters["rejected_batches"] += 1
+		self.counters["rejected_events"] += len(events)
+
+		self.log.warning(f"Batch rejected ({len(events)} events dropped): {error}")
+
+		return True
+
+	async def _send(self, events):
 		try:
 			await self.transport.send(events)
 
 			self.log.info(f"Flushed batch ({len(events)} events)")
 
 		except Exception as e:
+			if self._rejected(events, e):
+				return
+
 			self.log.warning(f"Flush failed: {e}")
 
-	async def close(self):
+			if self.spool:
+				await self._spill(events)
+
+	async def _spill(self, events):
+		await asyncio.to_thread(self.spool.append, events)
+
+		self._spilled.set()
+
+		self.log.info(f"Spooled batch ({len(events)} events)")
+
+	async def replay(self):
 		"""
-		Stop dispatcher and flush remaining events.
+		Resends spooled batches, oldest first, once the transport is accepting them again.
+		"""
+
+		if not self.spool:
+			return
+
+		while self._running:
+			batch = await asyncio.to_thread(self.spool.peek)
+
+			if batch is None:
+				self._spilled.clear()
+
+				try:
+					await asyncio.wait_for(self._spilled.wait(), self.interval)
+
+				except asyncio.TimeoutError:
+					await asyncio.to_thread(self.spool.sync)
+
+				continue
+
+			try:
+				await self.transport.send(batch)
+
+			except Exception as e:
+				if not self._rejected(batch, e):
+					self.log.debug(f"Replay failed: {e}")
+
+					await asyncio.sleep(self.interval)
+
+					continue
+
+				await asyncio.to_thread(self.spool.commit, False)
+
+				continue
+
+			await asyncio.to_thread(self.spool.commit)
+
+			self.log.info(f"Replayed spooled batch ({len(batch)} events)")
+
+	def _report_dropped(self):
+		dropped = sum(self.dropped.values())
+
+		if dropped > self._dropped_reported:
+			self.log.warning(
+				f"Queue full ({self.policy}); dropped {dropped - self._dropped_reported} "
+				f"events since last flush: {dict(self.dropped)}"
+			)
+
+			self._dropped_reported = dropped
+
+	async def close(self, timeout=None):
+		"""
+		Stop dispatcher and flush remaining events; whatever can't be sent within `timeout`
+		seconds is written to the spool (if any), to be replayed after the next startup.
 		"""
 
 		self._running = False
 
-		await self.flush()
+		async def _drain():
+			await self.flush()
+
+			while self._sending:
+				await asyncio.wait(set(self._sending))
+
+		try:
+			await asyncio.wait_for(_drain(), timeout)
+
+		except asyncio.TimeoutError:
+			self.log.warning(f"Flush timed out after {timeout}s")
+
+		for task in self._sending:
+			task.cancel()
+
+		await asyncio.gather(*self._sending, return_exceptions=True)
+
+		if self.spool:
+			while events := self._take_batch():
+				self.spool.append(events)
+
+			self.spool.close()
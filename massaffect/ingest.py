@@ -0,0 +1,93 @@
+import asyncio
+import collections
+import os
+import socket
+
+from .util import Loggable
+
+class DatagramReceiver(asyncio.DatagramProtocol, Loggable):
+	"""
+	Receives events on the agent's (optional) `SOCK_DGRAM` socket, for fire-and-forget producers
+	that can't afford a connection per event; every datagram is a single JSON event, or a list
+	of events. Datagrams are buffered by the protocol and handed over in batches by `batches`,
+	so the event loop does no decoding per `recvfrom`. Once `max_pending` datagrams are waiting,
+	new ones are dropped (and counted).
+
+	Unix datagram sockets don't lose data silently: when the receive queue is full the sender's
+	(non-blocking) `sendto` fails with EAGAIN, so those drops are only visible to producers.
+	"""
+
+	def __init__(self, max_pending=8192):
+		self.max_pending = max_pending
+		self.pending = []
+		self.transport = None
+		self.counters = collections.Counter()
+
+		self._ready = asyncio.Event()
+
+	async def start(self, name, rcvbuf=0):
+		"""
+		Binds to `name` (a leading NUL makes it an abstract socket), optionally setting the
+		socket's receive buffer to `rcvbuf` bytes.
+		"""
+
+		if not name.startswith("\0") and os.path.exists(name):
+			os.unlink(name)
+
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+		if rcvbuf:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+		sock.bind(name)
+		sock.setblocking(False)
+
+		self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+			lambda: self,
+			sock=sock
+		)
+
+		self.log.debug(f"Created datagram socket: {name.replace(chr(0), '@')}")
+
+	def datagram_received(self, data, addr):
+		self.counters["received"] += 1
+
+		if len(self.pending) >= self.max_pending:
+			self.counters["dropped"] += 1
+
+			return
+
+		self.pending.append(data)
+		self._ready.set()
+
+	def error_received(self, exc):
+		self.counters["error"] += 1
+
+		self.log.warning(f"Datagram socket error: {exc}")
+
+	def take(self):
+		"""Returns (and forgets) every buffered datagram."""
+
+		pending, self.pending = self.pending, []
+
+		self._ready.clear()
+
+		return pending
+
+	async def batches(self):
+		"""Yields the buffered datagrams, as a list, whenever there are any."""
+
+		while True:
+			await self._ready.wait()
+
+			yield self.take()
+
+	def stats(self):
+		return {
+			"pending": len(self.pending),
+			**self.counters,
+		}
+
+	def close(self):
+		if self.transport:
+			self.transport.close()
@@ -0,0 +1,159 @@
+import collections
+import fnmatch
+import time
+
+from .util import Loggable
+
+# What happens to events over their collector's limit:
+#
+#   drop      - discard them; they're only counted (see `RateLimiter.stats`)
+#   summarize - discard them, but report how many were suppressed in a single event per interval
+OVERFLOW_POLICIES = ("drop", "summarize")
+
+class TokenBucket:
+	"""
+	Allows `rate` events per second on average, and bursts of up to `burst` events.
+	"""
+
+	__slots__ = ("rate", "burst", "tokens", "updated")
+
+	def __init__(self, rate, burst, now):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = now
+
+	def refill(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+		return self.tokens >= self.burst
+
+	def take(self, now):
+		self.refill(now)
+
+		if self.tokens >= 1:
+			self.tokens -= 1
+
+			return True
+
+		return False
+
+class RateLimiter(Loggable):
+	"""
+	Token-bucket limits on the events producers write to the agent's sockets, per `collector`
+	value; and with `per_peer`, per (collector, peer uid), the uid coming from the stream
+	socket's SO_PEERCRED (datagrams carry no credentials, so they share the collector's
+	bucket). `rate` and `burst` apply to every collector, unless overridden by an entry in
+	`collectors` (keyed by name, or an fnmatch pattern, like lanes); a `rate` of 0 is unlimited.
+	"""
+
+	def __init__(self, rate=0.0, burst=0, per_peer=False, overflow="drop", collectors=None):
+		self.rate = rate
+		self.burst = burst
+		self.per_peer = per_peer
+		self.overflow = overflow
+		self.collectors = collectors or {}
+
+		# (collector, uid) -> TokenBucket; uid is None unless `per_peer`.
+		self.buckets = {}
+
+		# Collectors without a limit (so their options aren't looked up for every event).
+		self.unlimited = set()
+
+		# Suppressed event counts; cumulative, and since the last `summary`.
+		self.suppressed = collections.Counter()
+		self.pending = collections.Counter()
+
+	@property
+	def enabled(self):
+		return bool(self.rate or any(o.get("rate") for o in self.collectors.values()))
+
+	def _limits(self, collector):
+		options = self.collectors.get(collector)
+
+		if options is None:
+			options = next(
+				(o for pattern, o in self.collectors.items() if fnmatch.fnmatchcase(collector, pattern)),
+				{}
+			)
+
+		rate = options.get("rate", self.rate)
+		burst = options.get("burst", self.burst)
+
+		# A bucket holds at least a second's worth of events.
+		return rate, max(burst, rate, 1)
+
+	def allow(self, collector, uid=None):
+		if collector in self.unlimited:
+			return True
+
+		key = (collector, uid if self.per_peer else None)
+		bucket = self.buckets.get(key)
+		now = time.monotonic()
+
+		if bucket is None:
+			rate, burst = self._limits(collector)
+
+			if not rate:
+				self.unlimited.add(collector)
+
+				return True
+
+			bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+
+		if bucket.take(now):
+			return True
+
+		self.suppressed[key] += 1
+		self.pending[key] += 1
+
+		return False
+
+	def summary(self):
+		"""
+		Returns the metrics of a "suppressed" event covering everything suppressed since the
+		last call (or None, if nothing was); also forgets buckets that have refilled, so
+		one-off collector names don't accumulate. Called once per interval.
+		"""
+
+		now = time.monotonic()
+
+		for key, bucket in list(self.buckets.items()):
+			if bucket.refill(now):
+				del self.buckets[key]
+
+		self.unlimited.clear()
+
+		if not self.pending:
+			return None
+
+		metrics = {
+			"total": sum(self.pending.values()),
+			"collectors": collections.Counter(),
+		}
+
+		for (collector, uid), count in self.pending.items():
+			metrics["collectors"][collector] += count
+
+			if uid is not None:
+				metrics.setdefault("peers", {}).setdefault(str(uid), 0)
+				metrics["peers"][str(uid)] += count
+
+		metrics["collectors"] = dict(metrics["collectors"])
+
+		self.log.warning(f"Suppressed {metrics['total']} events over their rate limits")
+
+		self.pending.clear()
+
+		return metrics
+
+	def stats(self):
+		stats = {}
+
+		for (collector, uid), count in self.suppressed.items():
+			name = collector if uid is None else f"{collector}@{uid}"
+
+			stats[name] = count
+
+		return {"suppressed": stats} if stats else {}
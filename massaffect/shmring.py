@@ -0,0 +1,263 @@
+"""
+A shared-memory ring buffer for very high-rate local producers; events are copied into an
+mmap'ed file (typically under `/dev/shm`), instead of being sent over a socket.
+
+The file is a 256 byte header followed by `capacity` bytes of data (a multiple of 8). All
+integers are little-endian; `head`, `tail` and `dropped` sit on separate cache lines:
+
+	offset  size
+	     0     4  magic, b"MARB"
+	     4     4  u32 version (1)
+	     8     8  u64 capacity
+	    64     8  u64 head; bytes ever written (only advanced by producers, under the lock)
+	    72     8  u64 dropped; frames producers discarded because the ring was full
+	   128     8  u64 tail; bytes ever consumed (only advanced by the consumer)
+	   256        data
+
+A frame starts at data offset `head % capacity`, and is a u32 length followed by that many
+bytes of JSON (a single event, or a list of events), padded to a multiple of 8. A frame never
+wraps: if it doesn't fit before the end of the data, the producer writes a length of
+0xFFFFFFFF there, and the frame starts at offset 0 instead. Producers write the frame first and
+publish it by advancing `head`; the consumer reads every frame below `head`, then advances
+`tail` to release the space. So the consumer takes no lock at all.
+
+Producers serialize with an exclusive `flock` on the file, because Python has no atomic
+compare-and-swap to reserve space with. Taking and releasing it is two syscalls, more than the
+single `sendto` of a datagram (see `[agent.socket] dgram_name`); so a shared producer should
+batch, with `RingProducer.write_many`/`send_many`, which lock once for a whole list of events.
+A producer that has the ring to itself can instead claim it once (`exclusive`), and hold the
+lock until it closes; its writes are then just copies into memory, with no syscall at all. A
+native producer must use the same `flock` protocol.
+"""
+
+import collections
+import fcntl
+import json
+import mmap
+import os
+import struct
+
+from .util import Loggable
+
+MAGIC = b"MARB"
+VERSION = 1
+
+HEADER_SIZE = 256
+HEAD = 64
+DROPPED = 72
+TAIL = 128
+
+PREAMBLE = struct.Struct("<4sIQ")
+U64 = struct.Struct("<Q")
+FRAME = struct.Struct("<I")
+
+WRAP = 0xFFFFFFFF
+
+def _frame_size(length):
+	return (FRAME.size + length + 7) & ~7
+
+class Ring(Loggable):
+	def __init__(self, path, capacity=None, mode=0o660):
+		"""
+		Maps the ring at `path`; when `capacity` is given, the ring is (re)created with that many
+		data bytes, unless a valid ring of that size already exists (whose unconsumed frames
+		are then kept).
+		"""
+
+		self.path = path
+
+		if capacity is not None:
+			capacity = (capacity + 7) & ~7
+
+			if not self._valid(path, capacity):
+				self._create(path, capacity, mode)
+
+		self.fd = os.open(path, os.O_RDWR)
+		self.mm = mmap.mmap(self.fd, 0)
+
+		magic, version, self.capacity = PREAMBLE.unpack_from(self.mm, 0)
+
+		if magic != MAGIC or version != VERSION:
+			self.close()
+
+			raise ValueError(f"{path} is not a (version {VERSION}) ring buffer")
+
+	@staticmethod
+	def _valid(path, capacity):
+		try:
+			with open(path, "rb") as f:
+				magic, version, size = PREAMBLE.unpack(f.read(PREAMBLE.size))
+
+		except (OSError, struct.error):
+			return False
+
+		return magic == MAGIC and version == VERSION and size == capacity
+
+	def _create(self, path, capacity, mode):
+		tmp = f"{path}.tmp"
+		fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, mode)
+
+		try:
+			# The mode passed to `open` is subject to the umask; producers need write access.
+			os.fchmod(fd, mode)
+			os.ftruncate(fd, HEADER_SIZE + capacity)
+			os.pwrite(fd, PREAMBLE.pack(MAGIC, VERSION, capacity), 0)
+
+		finally:
+			os.close(fd)
+
+		os.replace(tmp, path)
+
+		self.log.info(f"Created ring buffer {path} ({capacity} bytes)")
+
+	def _get(self, offset):
+		return U64.unpack_from(self.mm, offset)[0]
+
+	def _set(self, offset, value):
+		U64.pack_into(self.mm, offset, value)
+
+	@property
+	def used(self):
+		return self._get(HEAD) - self._get(TAIL)
+
+	def close(self):
+		if getattr(self, "mm", None):
+			self.mm.close()
+
+		os.close(self.fd)
+
+class RingConsumer(Ring):
+	"""The (single) reading end; owned by the agent, which creates the ring."""
+
+	def __init__(self, path, capacity, mode=0o660):
+		super().__init__(path, capacity, mode)
+
+		self.counters = collections.Counter()
+
+	def read(self, max_frames=1024):
+		"""Returns (and releases) up to `max_frames` of the oldest frames' data."""
+
+		frames = []
+		head = self._get(HEAD)
+		tail = self._get(TAIL)
+
+		while tail < head and len(frames) < max_frames:
+			pos = tail % self.capacity
+			length = FRAME.unpack_from(self.mm, HEADER_SIZE + pos)[0]
+
+			if length == WRAP:
+				tail += self.capacity - pos
+
+				continue
+
+			if FRAME.size + length > self.capacity - pos:
+				self.log.warning(f"Corrupt frame at {pos}; discarding {head - tail} bytes")
+
+				self.counters["corrupt"] += 1
+
+				tail = head
+
+				break
+
+			start = HEADER_SIZE + pos + FRAME.size
+
+			frames.append(self.mm[start:start + length])
+
+			tail += _frame_size(length)
+
+		self._set(TAIL, tail)
+
+		self.counters["frames"] += len(frames)
+
+		return frames
+
+	def stats(self):
+		return {
+			"used_bytes": self.used,
+			"dropped": self._get(DROPPED),
+			**self.counters,
+		}
+
+class RingProducer(Ring):
+	"""
+	A writing end, for any process with write access to the ring:
+
+		ring = RingProducer("/dev/shm/massaffect.ring")
+
+		ring.send_many([{"collector": "wordpress", "ts": ..., "metrics": {...}}, ...])
+
+	Every call locks the ring (see the module documentation), so events should be written in
+	batches; `send`/`write` (a single event) cost as many syscalls as a whole batch. With
+	`exclusive`, the lock is taken once, here, and held until `close`; other producers then
+	block until it's released, so this is for a ring with a single producer. `write_many` and
+	`send_many` return how many frames fit; `send`/`write` return False if the ring was full
+	(the frame is dropped and counted).
+	"""
+
+	def __init__(self, path, exclusive=False):
+		super().__init__(path)
+
+		self.exclusive = exclusive
+
+		if exclusive:
+			try:
+				fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+			except BlockingIOError:
+				self.close()
+
+				raise ValueError(f"{path} is in use by another producer")
+
+	def _write(self, data):
+		size = _frame_size(len(data))
+
+		if size > self.capacity:
+			raise ValueError(f"Frame of {len(data)} bytes exceeds the ring's capacity")
+
+		head = self._get(HEAD)
+		pos = head % self.capacity
+		skip = self.capacity - pos if self.capacity - pos < size else 0
+
+		if head + skip + size - self._get(TAIL) > self.capacity:
+			self._set(DROPPED, self._get(DROPPED) + 1)
+
+			return False
+
+		if skip:
+			FRAME.pack_into(self.mm, HEADER_SIZE + pos, WRAP)
+
+			pos = 0
+
+		start = HEADER_SIZE + pos
+
+		FRAME.pack_into(self.mm, start, len(data))
+
+		self.mm[start + FRAME.size:start + FRAME.size + len(data)] = data
+
+		# Publishing the frame; the consumer won't look at it before this.
+		self._set(HEAD, head + skip + size)
+
+		return True
+
+	def write_many(self, frames):
+		"""Writes every frame (bytes) under a single lock; returns how many fit."""
+
+		if self.exclusive:
+			return sum(self._write(data) for data in frames)
+
+		fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+		try:
+			return sum(self._write(data) for data in frames)
+
+		finally:
+			fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+	def write(self, data):
+		return self.write_many([data]) == 1
+
+	def send_many(self, events):
+		return self.write_many([json.dumps(e, separators=(",", ":")).encode() for e in events])
+
+	def send(self, event):
+		return self.send_many([event]) == 1
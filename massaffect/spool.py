@@ -0,0 +1,240 @@
+import collections
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from pathlib import Path
+
+from .codec import json_event
+from .util import Loggable
+from .state import FileStateStore
+
+class Spool(Loggable):
+	"""
+	A persistent, on-disk FIFO of batches that couldn't be delivered.
+
+	Batches are appended as records to segment files named `<seq>.seg` (16 hex digits), each
+	record being:
+
+		u32 length | u32 crc32 | `length` bytes of compact JSON (the list of events)
+
+	A new segment is started once the current one exceeds `segment_bytes` (and on every
+	startup, so a torn record from a crash is never appended to). When the spool grows past
+	`max_bytes`, the oldest segments are evicted. Writes are fsync'ed in groups; after
+	`fsync_batches` appends or `fsync_interval` seconds, whichever comes first.
+
+	The read position is persisted in `cursor.json`, so replay resumes where it stopped after
+	an agent restart. All methods block (on disk IO) and are thread-safe; they are intended to
+	be called via `asyncio.to_thread`.
+	"""
+
+	RECORD = struct.Struct("<II")
+
+	def __init__(self,
+		path,
+		max_bytes=256 * 1024 * 1024,
+		segment_bytes=8 * 1024 * 1024,
+		fsync_batches=16,
+		fsync_interval=1.0
+	):
+		self.path = Path(path)
+		self.max_bytes = max_bytes
+		self.segment_bytes = segment_bytes
+		self.fsync_batches = fsync_batches
+		self.fsync_interval = fsync_interval
+
+		self.counters = collections.Counter()
+
+		self.path.mkdir(parents=True, exist_ok=True)
+
+		self._lock = threading.RLock()
+		self._cursor = FileStateStore(self.path / "cursor.json")
+		self._segments = sorted(int(p.stem, 16) for p in self.path.glob("*.seg"))
+		self._sizes = {seq: self._segment(seq).stat().st_size for seq in self._segments}
+		self._writer = None
+		self._unsynced = 0
+		self._synced = time.monotonic()
+		self._peeked = None
+
+		self._open_segment()
+
+		if self.pending:
+			self.log.info(f"Found {self.pending_bytes} spooled bytes in {self.path}")
+
+	def _segment(self, seq):
+		return self.path / f"{seq:016x}.seg"
+
+	def _open_segment(self):
+		if self._writer:
+			self._sync()
+			self._writer.close()
+
+		seq = self._segments[-1] + 1 if self._segments else 0
+
+		self._segments.append(seq)
+		self._sizes[seq] = 0
+		self._writer = self._segment(seq).open("ab")
+
+	def _sync(self):
+		if self._unsynced:
+			self._writer.flush()
+
+			os.fsync(self._writer.fileno())
+
+		self._unsynced = 0
+		self._synced = time.monotonic()
+
+	def _position(self):
+		seq = self._cursor.get("segment", self._segments[0])
+		offset = self._cursor.get("offset", 0)
+
+		# The cursor's segment was evicted (or deleted by hand); start at the oldest remaining.
+		if seq not in self._sizes:
+			return self._segments[0], 0
+
+		return seq, offset
+
+	def _set_position(self, seq, offset):
+		self._cursor.set("segment", seq)
+		self._cursor.set("offset", offset)
+		self._cursor.save()
+
+	def _remove(self, seq):
+		self._segments.remove(seq)
+
+		size = self._sizes.pop(seq)
+
+		self._segment(seq).unlink(missing_ok=True)
+
+		return size
+
+	def _evict(self):
+		while len(self._segments) > 1 and self.pending_bytes > self.max_bytes:
+			seq = self._segments[0]
+
+			self.counters["evicted_bytes"] += self._remove(seq)
+			self.counters["evicted_segments"] += 1
+
+			self.log.warning(f"Spool over {self.max_bytes} bytes; evicted segment {seq:016x}")
+
+	@property
+	def pending_bytes(self):
+		with self._lock:
+			seq, offset = self._position()
+
+			return sum(size for s, size in self._sizes.items() if s >= seq) - offset
+
+	@property
+	def pending(self):
+		return self.pending_bytes > 0
+
+	def append(self, events):
+		data = b"[" + b",".join(json_event(e, self._dumps) for e in events) + b"]"
+
+		with self._lock:
+			if self._sizes[self._segments[-1]] >= self.segment_bytes:
+				self._open_segment()
+
+			self._writer.write(self.RECORD.pack(len(data), zlib.crc32(data)))
+			self._writer.write(data)
+
+			self._sizes[self._segments[-1]] += self.RECORD.size + len(data)
+			self._unsynced += 1
+
+			self.counters["spilled_batches"] += 1
+			self.counters["spilled_events"] += len(events)
+
+			if (
+				self._unsynced >= self.fsync_batches or
+				time.monotonic() - self._synced >= self.fsync_interval
+			):
+				self._sync()
+
+			self._evict()
+
+	@staticmethod
+	def _dumps(event):
+		return json.dumps(event, separators=(",", ":")).encode()
+
+	def sync(self):
+		with self._lock:
+			self._sync()
+
+	def peek(self):
+		"""
+		Returns the oldest undelivered batch (or None); it stays in the spool until `commit`.
+		"""
+
+		with self._lock:
+			self._writer.flush()
+
+			while True:
+				seq, offset = self._position()
+
+				with self._segment(seq).open("rb") as f:
+					f.seek(offset)
+
+					header = f.read(self.RECORD.size)
+
+					if len(header) == self.RECORD.size:
+						length, crc = self.RECORD.unpack(header)
+						data = f.read(length)
+
+						if len(data) == length and zlib.crc32(data) == crc:
+							self._peeked = (seq, offset + self.RECORD.size + length)
+
+							return json.loads(data)
+
+						self.log.warning(f"Corrupt record in segment {seq:016x} at {offset}")
+
+				# This is the segment being written; there's nothing more to read (yet).
+				if seq == self._segments[-1]:
+					if offset < self._sizes[seq]:
+						self._set_position(seq, self._sizes[seq])
+
+					return None
+
+				# Done with this segment (or the rest of it is unreadable); move to the next.
+				self._remove(seq)
+				self._set_position(self._segments[0], 0)
+
+	def commit(self, delivered=True):
+		"""
+		Marks the batch returned by the last `peek` as delivered (or, if not `delivered`, as
+		discarded).
+		"""
+
+		with self._lock:
+			if not self._peeked:
+				return
+
+			seq, offset = self._peeked
+
+			self._peeked = None
+
+			# The segment was evicted while its batch was being replayed.
+			if seq not in self._sizes:
+				return
+
+			self._set_position(seq, offset)
+
+			self.counters["replayed_batches" if delivered else "discarded_batches"] += 1
+
+	def stats(self):
+		return {
+			"pending_bytes": self.pending_bytes,
+			"segments": len(self._segments),
+			**self.counters,
+		}
+
+	def close(self):
+		with self._lock:
+			self._sync()
+			self._writer.close()
+
+			# Don't leave an empty segment behind for every restart.
+			if self._sizes[self._segments[-1]] == 0 and len(self._segments) > 1:
+				self._remove(self._segments[-1])
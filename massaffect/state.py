@@ -1,6 +1,7 @@
 # from __future__ import annotations
 
 import json
+import os
 
 from pathlib import Path
 from typing import Any
@@ -18,6 +19,9 @@ class StateStore:
 	def delete(self, key: str) -> None:
 		raise NotImplementedError
 
+	def keys(self) -> list[str]:
+		raise NotImplementedError
+
 	def save(self) -> None:
 		pass
 
@@ -38,15 +42,24 @@ class MemoryStateStore(StateStore):
 	def delete(self, key: str) -> None:
 		self._state.pop(key, None)
 
+	def keys(self) -> list[str]:
+		return list(self._state)
+
 
 # ================================================================================================
 # File-backed (persistent)
 
 class FileStateStore(StateStore):
+	"""
+	Kept in memory, and written to `path` by `save`; only if something changed since the last
+	save, and atomically (via a temporary file), so a crash mid-save can't corrupt it.
+	"""
+
 	def __init__(self, path: Path):
 		self.path = path
 
 		self._state: dict[str, Any] = {}
+		self._dirty = False
 		self._load()
 
 	def _load(self) -> None:
@@ -54,14 +67,30 @@ class FileStateStore(StateStore):
 			self._state = json.loads(self.path.read_text())
 
 	def save(self) -> None:
+		if not self._dirty:
+			return
+
 		self.path.parent.mkdir(parents=True, exist_ok=True)
-		self.path.write_text(json.dumps(self._state, indent=2))
+
+		tmp = self.path.with_name(f"{self.path.name}.tmp")
+
+		tmp.write_text(json.dumps(self._state, separators=(",", ":")))
+
+		os.replace(tmp, self.path)
+
+		self._dirty = False
 
 	def get(self, key: str, default: Any = None) -> Any:
 		return self._state.get(key, default)
 
 	def set(self, key: str, value: Any) -> None:
-		self._state[key] = value
+		if self._state.get(key) != value:
+			self._state[key] = value
+			self._dirty = True
 
 	def delete(self, key: str) -> None:
-		self._state.pop(key, None)
+		if self._state.pop(key, None) is not None:
+			self._dirty = True
+
+	def keys(self) -> list[str]:
+		return list(self._state)
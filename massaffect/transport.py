@@ -1,96 +1,720 @@
 import aiohttp
+import asyncio
+import bisect
+import collections
 import hmac
 import hashlib
 import logging
 import json
-import gzip
+import random
+import time
 
 from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 from . import config
+from . import codec
+from .connection import ConnectionManager
+from . import columnar
 from .util import Loggable
 
+# Only needed by `DirectTransport`.
+try:
+	import psycopg
+	import redis
+
+	from . import database
+
+except ModuleNotFoundError:
+	database = None
+
+class TransportError(Exception):
+	"""
+	Raised by `Transport.send` when a batch wasn't delivered; `retryable` is False for errors
+	that won't go away by themselves (bad signature, unknown agent, etc).
+	"""
+
+	def __init__(self, message, retryable=True, retry_after=None):
+		super().__init__(message)
+
+		self.retryable = retryable
+		self.retry_after = retry_after
+
+class CircuitOpenError(TransportError):
+	"""Raised without trying to send at all; the batch may be retried once a circuit closes."""
+
+class RetryPolicy:
+	"""
+	Capped exponential backoff with "full jitter": the delay before retry `n` (0-based) is
+	uniformly distributed over [0, min(cap, base * 2^n)], so agents that failed together don't
+	retry together. A server-provided `Retry-After` is honored (plus up to `base` seconds of
+	jitter), unless it exceeds `cap`; in that case the batch is given up on immediately.
+	"""
+
+	def __init__(self, attempts=4, base=0.5, cap=30.0):
+		self.attempts = attempts
+		self.base = base
+		self.cap = cap
+
+	def delay(self, attempt, retry_after=None):
+		if attempt >= self.attempts:
+			return None
+
+		if retry_after is not None:
+			if retry_after > self.cap:
+				return None
+
+			return retry_after + random.uniform(0, self.base)
+
+		return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+class CircuitBreaker:
+	"""
+	Stops sending to a controller after `threshold` consecutive failures ("open"); once
+	`reset_timeout` seconds (plus up to 50% jitter) have passed, a single probe request is let
+	through ("half-open"), whose outcome either closes the circuit again or re-opens it.
+	"""
+
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half_open"
+
+	def __init__(self, threshold=5, reset_timeout=30.0):
+		self.threshold = threshold
+		self.reset_timeout = reset_timeout
+		self.state = self.CLOSED
+		self.failures = 0
+
+		self._retry_at = 0
+		self._probing = False
+
+	def allow(self):
+		if self.state == self.CLOSED:
+			return True
+
+		if self.state == self.OPEN and time.monotonic() >= self._retry_at:
+			self.state = self.HALF_OPEN
+			self._probing = False
+
+		if self.state == self.HALF_OPEN and not self._probing:
+			self._probing = True
+
+			return True
+
+		return False
+
+	def success(self):
+		self.state = self.CLOSED
+		self.failures = 0
+		self._probing = False
+
+	def release(self):
+		"""Frees the half-open probe slot, if the probe ended with neither outcome recorded."""
+
+		self._probing = False
+
+	def failure(self):
+		self.failures += 1
+		self._probing = False
+
+		if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+			self.state = self.OPEN
+			self._retry_at = time.monotonic() + self.reset_timeout * random.uniform(1, 1.5)
+
+class HashRing:
+	"""
+	A consistent hash ring; every node is placed at `replicas` points, so keys are spread evenly
+	and adding or removing a node only moves the keys of its own arcs. `order(key)` returns all
+	the nodes, starting with the one owning `key` and continuing clockwise (the failover order).
+	"""
+
+	def __init__(self, nodes, replicas=100):
+		self.nodes = list(nodes)
+
+		self._points = sorted(
+			(self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas)
+		)
+
+		self._hashes = [h for h, _ in self._points]
+
+	@staticmethod
+	def _hash(value):
+		return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+	def order(self, key):
+		start = bisect.bisect(self._hashes, self._hash(key))
+		nodes = {}
+
+		for i in range(len(self._points)):
+			nodes.setdefault(self._points[(start + i) % len(self._points)][1], None)
+
+			if len(nodes) == len(self.nodes):
+				break
+
+		return list(nodes)
+
+class Controller:
+	"""A controller URL and the circuit breaker tracking its health."""
+
+	def __init__(self, url, breaker):
+		self.url = url
+		self.breaker = breaker
+
+	def __repr__(self):
+		return self.url
+
+def _retry_after(value):
+	"""
+	Parses a `Retry-After` header (either delta-seconds or an HTTP-date) into seconds.
+	"""
+
+	if not value:
+		return None
+
+	try:
+		return max(0.0, float(value))
+
+	except ValueError:
+		pass
+
+	try:
+		return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+
+	except (TypeError, ValueError):
+		return None
+
+async def _stream(chunks):
+	for chunk in chunks:
+		yield chunk
+
 class Transport(ABC, Loggable):
+	# Size of the chunks fed to the HMAC/compressor (and streamed as the request body).
+	CHUNK_SIZE = 64 * 1024
+
+	# Batches with at least this many events are encoded in a worker thread, so the event loop
+	# (socket ingestion, collector sampling) isn't stalled by a multi-MB batch.
+	OFFLOAD_EVENTS = 256
+
 	def __init__(self):
-		self.log.debug(f"Compression threshold: {config().agent.compression_threshold}")
+		# Collector names the receiver asked to resend a delta keyframe for (see `delta.py`).
+		self.resync = set()
+
+		self.serializer = codec.SERIALIZERS[config().agent.serializer]()
+		self.compressor = codec.COMPRESSORS[config().agent.compression](
+			config().agent.compression_level
+		)
+
+		self.log.debug(
+			f"Codec: {self.serializer.NAME}+{self.compressor.NAME} "
+			f"(level {self.compressor.level}); "
+			f"compression threshold: {config().agent.compression_threshold}"
+		)
+
+	def _encode(self, payload):
+		"""
+		Serializes, signs and (above `compression_threshold`) compresses `payload` in a single
+		pass over `CHUNK_SIZE` chunks. Returns the headers and the list of body chunks; only the
+		final (possibly compressed) body is held in memory.
+		"""
 
-	def _headers_body(self, payload):
 		# Ensure we always send a list (defensive safety)
 		if not isinstance(payload, list):
 			payload = [payload]
 
-		# Canonical JSON (no spaces)
-		raw_body = json.dumps(
-			payload,
-			separators=(",", ":"),
-		).encode()
+		threshold = config().agent.compression_threshold
+
+		if config().agent.batch_format == "columnar":
+			body = [self.serializer.dumps(columnar.encode_batch(codec.materialize(payload)))]
+
+		else:
+			body = self.serializer.chunks(payload, self.CHUNK_SIZE)
 
-		# Sign the RAW JSON
-		signature = hmac.new(
-			config().agent.agent_secret.encode(),
-			raw_body,
-			hashlib.sha256,
-		).hexdigest()
+		# Sign the RAW (uncompressed) serialized body
+		mac = hmac.new(config().agent.agent_secret.encode(), digestmod=hashlib.sha256)
+
+		compressor = None
+		chunks = []
+		raw_size = 0
+
+		for chunk in body:
+			mac.update(chunk)
+
+			raw_size += len(chunk)
+
+			if compressor is None and self.compressor.ENCODING and raw_size > threshold:
+				compressor = self.compressor.compressobj()
+				chunks = [compressor.compress(c) for c in chunks]
+
+			chunks.append(compressor.compress(chunk) if compressor else chunk)
 
 		headers = {
-			"Content-Type": "application/json",
-			"x-agent-signature": signature,
+			"Content-Type": self.serializer.CONTENT_TYPE,
+			"x-agent-signature": mac.hexdigest(),
 		}
 
-		if len(raw_body) > config().agent.compression_threshold:
-			body = gzip.compress(raw_body)
-			ratio = len(body) / len(raw_body)
+		if config().agent.batch_format == "columnar":
+			headers["x-batch-format"] = columnar.FORMAT
+
+		if compressor:
+			chunks.append(compressor.flush())
 
-			headers["Content-Encoding"] = "gzip"
+			headers["Content-Encoding"] = self.compressor.ENCODING
 
+		chunks = [c for c in chunks if c]
+		size = sum(len(c) for c in chunks)
+
+		headers["Content-Length"] = str(size)
+
+		if compressor:
 			self.log.debug(
-				f"size: {len(raw_body)} "
-				f"compressed: {len(body)} "
-				f"ratio: {ratio:.2f}"
+				f"size: {raw_size} "
+				f"compressed: {size} "
+				f"ratio: {size / raw_size:.2f}"
 			)
 
 		else:
-			body = raw_body
+			self.log.debug(f"size: {raw_size}")
 
-			self.log.debug(f"size: {len(raw_body)}")
+		return headers, chunks
 
-		return headers, body
+	async def _encode_async(self, payload):
+		if isinstance(payload, list) and len(payload) >= self.OFFLOAD_EVENTS:
+			return await asyncio.to_thread(self._encode, payload)
+
+		return self._encode(payload)
+
+	def _headers_body(self, payload):
+		headers, chunks = self._encode(payload)
+
+		return headers, b"".join(chunks)
 
 	@abstractmethod
 	async def send(self, payload):
 		pass
 
+	async def warm(self):
+		"""Called shortly before a scheduled flush, to prepare (e.g. connect) for the send."""
+
+		pass
+
+	def stats(self):
+		return {}
+
 class HTTPTransport(Transport):
+	"""
+	Sends batches to the controller(s), retrying transient failures (timeouts, connection errors,
+	5xx, 429) according to a `RetryPolicy`.
+
+	With several `controllers`, the agent's primary is chosen by consistent hashing of its name,
+	so agents spread evenly and each one sticks to the same controller. Every controller has its
+	own `CircuitBreaker`; a failed send fails over to the next controller on the ring at once,
+	and a controller whose circuit is open is skipped (ejected) until its probe succeeds. Only
+	once every available controller has failed is the retry delay applied.
+	"""
+
 	def __init__(self):
-		self.session = aiohttp.ClientSession(
-			timeout=aiohttp.ClientTimeout(total=5)
+		super().__init__()
+
+		self.connections = ConnectionManager(
+			pool_size=config().agent.http.pool_size,
+			keepalive=config().agent.http.keepalive,
+			connect_timeout=config().agent.http.connect_timeout,
+			read_timeout=config().agent.http.read_timeout,
+			total_timeout=config().agent.http.total_timeout,
+			dns_ttl=config().agent.http.dns_ttl
 		)
 
-		self.log.info(f"Session opened to {config().agent.controller_url}")
+		self.session = self.connections.session
+
+		self.retry = RetryPolicy(
+			attempts=config().agent.retry.attempts,
+			base=config().agent.retry.backoff_base,
+			cap=config().agent.retry.backoff_cap
+		)
+
+		controllers = {
+			url: Controller(url, CircuitBreaker(
+				threshold=config().agent.retry.circuit_threshold,
+				reset_timeout=config().agent.retry.circuit_reset
+			))
+			for url in config().agent.controllers
+		}
+
+		# The failover order for this agent; the first is its primary.
+		self.controllers = [
+			controllers[url]
+			for url in HashRing(controllers).order(config().agent.name)
+		]
+
+		# Outcome -> count (sent, retried, failed, rejected, failover, throttled, timeout, error,
+		# http_NNN).
+		self.counters = collections.Counter()
+
+		self.log.info(f"Session opened to {', '.join(c.url for c in self.controllers)}")
+
+	def _pick(self, tried):
+		"""
+		Returns the first controller (in ring order) not yet `tried` whose circuit lets a
+		request through, or None.
+		"""
+
+		for controller in self.controllers:
+			if controller not in tried and controller.breaker.allow():
+				return controller
+
+		return None
+
+	def _reply(self, body):
+		"""
+		Picks the collectors to resync out of an accepting reply; the batch was delivered, so an
+		unexpected body is only logged.
+		"""
+
+		try:
+			reply = json.loads(body)
+
+		except ValueError as e:
+			self.log.warning(f"Unparsable reply: {e}")
+
+			return
+
+		resync = reply.get("resync") if isinstance(reply, dict) else None
+
+		if isinstance(resync, list):
+			self.resync.update(name for name in resync if isinstance(name, str))
+
+		elif resync is not None:
+			self.log.warning(f"Unexpected resync in reply: {resync!r}")
+
+	async def _post(self, url, headers, chunks):
+		timing = self.connections.timing()
+
+		try:
+			async with self.session.post(
+				url,
+				data=_stream(chunks),
+				headers=headers,
+				trace_request_ctx=timing,
+			) as resp:
+				reply = await resp.read()
+
+				self.connections.record(timing)
+
+				if 200 <= resp.status < 300:
+					if resp.content_type == "application/json":
+						self._reply(reply)
+
+					return
+
+				self.counters[f"http_{resp.status}"] += 1
+
+				if resp.status in (429, 503):
+					self.counters["throttled"] += 1
+
+					raise TransportError(
+						f"Bad response: {resp.status}",
+						retry_after=_retry_after(resp.headers.get("Retry-After"))
+					)
+
+				raise TransportError(
+					f"Bad response: {resp.status}",
+					retryable=resp.status >= 500
+				)
+
+		except asyncio.TimeoutError:
+			self.counters["timeout"] += 1
+
+			raise TransportError("Request timed out")
+
+		except aiohttp.ClientError as e:
+			self.counters["error"] += 1
+
+			raise TransportError(f"Request failed: {e}")
 
 	async def send(self, payload):
-		headers, body = self._headers_body(payload)
+		headers, chunks = await self._encode_async(payload)
+		attempt = 0
+		tried = set()
+		error = None
+
+		while True:
+			controller = self._pick(tried)
+
+			if controller is None:
+				if not tried:
+					self.counters["rejected"] += 1
+
+					raise CircuitOpenError("Circuit open; every controller is considered down")
+
+				# Every available controller failed once; back off, then go round again.
+				delay = self.retry.delay(attempt, error.retry_after)
+
+				if delay is None:
+					self.counters["failed"] += 1
+
+					raise error
+
+				self.counters["retried"] += 1
+
+				self.log.debug(f"{error}; retrying in {delay:.2f}s")
+
+				await asyncio.sleep(delay)
+
+				attempt += 1
+				tried.clear()
+
+				continue
+
+			try:
+				await self._post(controller.url, headers, chunks)
+
+			except TransportError as e:
+				# Only "the controller is unreachable/broken" counts against the circuit; a 4xx
+				# means it's up, and so does a 429/503 with a Retry-After (it's just busy). One
+				# without a Retry-After is treated like any other failure.
+				if e.retryable and e.retry_after is None:
+					controller.breaker.failure()
+
+				if not e.retryable:
+					controller.breaker.success()
+
+					self.counters["failed"] += 1
+
+					raise
+
+				self.log.debug(f"{controller}: {e}")
+
+				if len(tried) + 1 < len(self.controllers):
+					self.counters["failover"] += 1
+
+				tried.add(controller)
 
-		async with self.session.post(
-			config().agent.controller_url,
-			data=body,
-			headers=headers,
-		) as resp:
-			if resp.status != 200:
-				raise Exception(f"Bad response: {resp.status}")
+				error = e
+
+				continue
+
+			finally:
+				# Cancelled (or failed some unexpected way) as a half-open probe: let another
+				# request probe, rather than leaving the circuit stuck.
+				controller.breaker.release()
+
+			controller.breaker.success()
+
+			self.counters["sent"] += 1
+
+			return
+
+	async def warm(self):
+		# The controller the next flush will (most likely) go to; no probe slot is used up.
+		for controller in self.controllers:
+			if controller.breaker.state != CircuitBreaker.OPEN:
+				await self.connections.warm(controller.url)
+
+				return
+
+	def stats(self):
+		return {
+			"primary": self.controllers[0].url,
+			"circuit": {c.url: c.breaker.state for c in self.controllers},
+			**self.counters,
+			"connection": self.connections.stats(),
+		}
 
 	async def close(self):
-		await self.session.close()
+		await self.connections.close()
 
 		self.log.info("Session closed")
 
+class DirectTransport(Transport):
+	"""
+	Writes batches straight into Redis and Postgres, using the same layout as the controller
+	(see `controller/src/routes/collect.js`); for agents running on the controller or database
+	host. A batch costs one pipelined Redis round trip and one `COPY` into `events`, instead of
+	an HTTP request and a command (plus an INSERT) per event. Redis is only written once the
+	`COPY` has committed; if either fails the whole batch is retried, so delivery is
+	at-least-once. Events Postgres would reject (a `ts` that isn't an integer, etc) are skipped,
+	so they can't hold up the rest of their batch.
+	"""
+
+	EVENT_FIELDS = ("collector", "ts", "metrics")
+
+	def __init__(self):
+		super().__init__()
+
+		if database is None:
+			raise RuntimeError("DirectTransport requires the `redis` and `psycopg` modules")
+
+		self.name = config().agent.name
+		self.max_events = config().agent.direct.max_events
+
+		# Redis holds exactly what the controller would have stored; always JSON.
+		self.json = codec.JSONSerializer()
+
+		self.redis = database.redis_connect_async()
+		self.pg = None
+
+		# A connection runs one COPY at a time (batches may be sent concurrently).
+		self._pg_lock = asyncio.Lock()
+
+		self.counters = collections.Counter()
+
+		self.log.info(f"Writing directly to Redis/Postgres as '{self.name}'")
+
+	def _prepare(self, payload):
+		"""
+		Returns the Redis values grouped by collector, and the rows for `COPY`. Events missing
+		any of `EVENT_FIELDS` (or with a null one) are skipped, though empty `metrics` are kept;
+		and so are those (counted as "invalid") whose `collector` isn't a string, or whose `ts`
+		isn't an integer (for the `BIGINT` column).
+		"""
+
+		if not isinstance(payload, list):
+			payload = [payload]
+
+		values = {}
+		rows = []
+
+		for event in payload:
+			if any(event.get(k) is None for k in self.EVENT_FIELDS):
+				self.counters["skipped"] += 1
+
+				continue
+
+			# `type`, as a bool is an int too.
+			if not isinstance(event["collector"], str) or type(event["ts"]) is not int:
+				self.counters["invalid"] += 1
+
+				continue
+
+			values.setdefault(event["collector"], []).append(
+				codec.json_event(event, self.json.dumps)
+			)
+
+			rows.append((
+				self.name,
+				event["collector"],
+				event["ts"],
+				self.json.dumps(event["metrics"]).decode()
+			))
+
+		return values, rows
+
+	async def _connect_pg(self):
+		if self.pg is None or self.pg.closed:
+			self.pg = await database.pg_connect_async()
+
+		return self.pg
+
+	async def _write_redis(self, values):
+		index = f"ma:agent:{self.name}:collectors:index"
+		pipe = self.redis.pipeline(transaction=False)
+
+		pipe.sadd("ma:agent:index", self.name)
+
+		for collector, events in values.items():
+			key = database.redis_events_key(self.name, collector)
+
+			# LPUSH with several values pushes them in order, so the newest ends up first.
+			pipe.lpush(key, *events)
+			pipe.ltrim(key, 0, self.max_events - 1)
+			pipe.sadd(index, collector)
+
+		try:
+			await pipe.execute()
+
+		except (redis.RedisError, OSError) as e:
+			self.counters["redis_error"] += 1
+
+			raise TransportError(f"Redis write failed: {e}")
+
+	async def _write_pg(self, rows):
+		async with self._pg_lock:
+			try:
+				conn = await self._connect_pg()
+
+				async with conn.transaction():
+					async with conn.cursor() as cur:
+						async with cur.copy(
+							"COPY events (agent, collector, ts, metrics) FROM STDIN"
+						) as copy:
+							for row in rows:
+								await copy.write_row(row)
+
+			# The rows themselves; retrying won't help.
+			except (psycopg.DataError, psycopg.IntegrityError) as e:
+				self.counters["pg_error"] += 1
+
+				raise TransportError(f"Postgres rejected the batch: {e}", retryable=False)
+
+			except (psycopg.Error, OSError) as e:
+				self.counters["pg_error"] += 1
+
+				# Start over with a fresh connection; this one may be broken.
+				if self.pg is not None:
+					await self.pg.close()
+
+					self.pg = None
+
+				raise TransportError(f"Postgres COPY failed: {e}")
+
+	async def send(self, payload):
+		if isinstance(payload, list) and len(payload) >= self.OFFLOAD_EVENTS:
+			values, rows = await asyncio.to_thread(self._prepare, payload)
+
+		else:
+			values, rows = self._prepare(payload)
+
+		if not rows:
+			return
+
+		# Postgres first, so a batch it fails isn't pushed into Redis again on every retry.
+		try:
+			await self._write_pg(rows)
+			await self._write_redis(values)
+
+		except TransportError:
+			self.counters["failed"] += 1
+
+			raise
+
+		self.counters["sent"] += 1
+		self.counters["events"] += len(rows)
+
+	async def warm(self):
+		try:
+			async with self._pg_lock:
+				await self._connect_pg()
+
+			await self.redis.ping()
+
+		except (psycopg.Error, redis.RedisError, OSError) as e:
+			self.log.debug(f"Warm-up failed: {e}")
+
+	def stats(self):
+		return dict(self.counters)
+
+	async def close(self):
+		await self.redis.aclose()
+
+		if self.pg is not None:
+			await self.pg.close()
+
+		self.log.info("Closed")
+
 # Simply logs `send/close`, rather than firing them off.
 class DebugTransport(Transport):
 	async def send(self, payload):
 		headers, body = self._headers_body(payload)
 
 		if "Content-Encoding" in headers:
-			body = gzip.decompress(body)
+			body = self.compressor.decompress(body)
+
+		if self.serializer.CONTENT_TYPE != "application/json":
+			body = json.dumps(self.serializer.decode(body)).encode()
+
+		if "x-batch-format" in headers:
+			body = json.dumps(columnar.decode_batch(json.loads(body))).encode()
 
 		self.log.info(f"Would send: {body.decode()}")
 
@@ -104,12 +728,16 @@ class DebugPrettyTransport(Transport):
 		headers, body = self._headers_body(payload)
 
 		if "Content-Encoding" in headers:
-			body = gzip.decompress(body)
+			body = self.compressor.decompress(body)
 
-		decoded = body.decode()
+		decoded = body.decode(errors="replace")
 
 		try:
-			parsed = json.loads(decoded)
+			parsed = self.serializer.decode(body)
+
+			if "x-batch-format" in headers:
+				parsed = columnar.decode_batch(parsed)
+
 			pretty = json.dumps(parsed, indent=2, sort_keys=True)
 
 		except Exception:
@@ -120,10 +748,18 @@ class DebugPrettyTransport(Transport):
 	async def close(self):
 		self.log.info("Closed")
 
+TRANSPORTS = {
+	"http": HTTPTransport,
+	"direct": DirectTransport,
+	"debug": DebugTransport,
+	"debug_pretty": DebugPrettyTransport,
+}
+
 # Accumulates into the `.sent` member (for use in pytest, etc).
 class TestTransport(Transport):
 	def __init__(self):
 		self.sent = []
+		self.resync = set()
 
 	async def send(self, payload):
 		self.sent.append(payload)
@@ -0,0 +1,201 @@
+"""
+File change notification via Linux inotify (through `ctypes`, so there's nothing to install),
+with a polling fallback where it isn't available.
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import struct
+
+from .util import Loggable
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# struct inotify_event: wd, mask, cookie, len; followed by `len` bytes of NUL-padded name.
+EVENT = struct.Struct("iIII")
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+def _libc():
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+		# Both are present in any glibc/musl of the last decade, but not on other platforms.
+		libc.inotify_init1
+		libc.inotify_add_watch
+
+	except (OSError, AttributeError):
+		return None
+
+	libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+
+	return libc
+
+class Watcher(Loggable):
+	"""
+	Watches directories (added with `watch`, along with the file name patterns of interest),
+	and wakes `wait` when a matching file in them is modified, created, moved or deleted.
+	Events arriving within `debounce` seconds of the first are coalesced into a single wake-up.
+
+	Directories in which matching files were created, moved or deleted are collected in
+	`changed` (see `take_changed`), so the owner can refresh just those; `overflowed` is set if
+	the kernel dropped events, in which case everything should be rescanned.
+
+	Without inotify (not Linux, or out of watches), `wait` simply sleeps for its timeout; i.e.
+	the caller polls.
+	"""
+
+	def __init__(self, debounce=0.25):
+		self.debounce = debounce
+		self.fd = None
+		self.changed = set()
+		self.overflowed = False
+
+		# Watch descriptor -> (directory, name patterns), and directory -> watch descriptor.
+		self.watches = {}
+		self.dirs = {}
+
+		self._changed = asyncio.Event()
+		self._exhausted = False
+
+	@property
+	def active(self):
+		return self.fd is not None
+
+	def start(self):
+		libc = _libc()
+
+		if libc is None:
+			self.log.info("inotify unavailable; polling")
+
+			return
+
+		fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+		if fd < 0:
+			self.log.warning(f"inotify_init1 failed ({os.strerror(ctypes.get_errno())}); polling")
+
+			return
+
+		self.libc = libc
+		self.fd = fd
+
+		asyncio.get_running_loop().add_reader(self.fd, self._read)
+
+	def watch(self, path, names):
+		"""Watches the directory `path` for files matching any of the fnmatch `names`."""
+
+		if not self.active or path in self.dirs:
+			return
+
+		wd = self.libc.inotify_add_watch(self.fd, path.encode(), WATCH_MASK | IN_ONLYDIR)
+
+		if wd < 0:
+			err = ctypes.get_errno()
+
+			# Out of watches (fs.inotify.max_user_watches) is only logged once; the directory is
+			# still polled, by the caller's timeout.
+			if err != errno.ENOSPC or not self._exhausted:
+				self.log.warning(f"Can't watch {path}: {os.strerror(err)}")
+
+			self._exhausted = err == errno.ENOSPC
+
+			return
+
+		self.watches[wd] = (path, names)
+		self.dirs[path] = wd
+
+		self.log.debug(f"Watching {path}")
+
+	def take_changed(self):
+		"""Returns (and forgets) the directories whose set of matching files has changed."""
+
+		changed, self.changed = self.changed, set()
+
+		return changed
+
+	def _read(self):
+		try:
+			data = os.read(self.fd, 64 * 1024)
+
+		except BlockingIOError:
+			return
+
+		offset = 0
+
+		while offset < len(data):
+			wd, mask, _, length = EVENT.unpack_from(data, offset)
+			name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0").decode(
+				errors="replace"
+			)
+
+			offset += EVENT.size + length
+
+			if mask & IN_Q_OVERFLOW:
+				self.overflowed = True
+				self._changed.set()
+
+				continue
+
+			watch = self.watches.get(wd)
+
+			if watch is None:
+				continue
+
+			# The directory was deleted (or unmounted); the owner forgets its files.
+			if mask & IN_IGNORED:
+				del self.watches[wd]
+				del self.dirs[watch[0]]
+
+				self.changed.add(watch[0])
+
+				continue
+
+			if any(fnmatch.fnmatchcase(name, n) for n in watch[1]):
+				if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+					self.changed.add(watch[0])
+
+				self._changed.set()
+
+	async def wait(self, timeout):
+		"""
+		Returns once a watched file has changed (after the debounce delay), or after `timeout`
+		seconds.
+		"""
+
+		if not self.active:
+			await asyncio.sleep(timeout)
+
+			return
+
+		try:
+			await asyncio.wait_for(self._changed.wait(), timeout)
+
+		except asyncio.TimeoutError:
+			return
+
+		await asyncio.sleep(self.debounce)
+
+		self._changed.clear()
+
+	def close(self):
+		if not self.active:
+			return
+
+		asyncio.get_running_loop().remove_reader(self.fd)
+
+		os.close(self.fd)
+
+		self.fd = None